@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Measure the per-call overhead of aevent's patched functions.
+
+Usage: python3 bench/patch_overhead.py [trio|asyncio]
+
+For a couple of calls that don't need to wait, this prints the time
+per call with the original stdlib implementation, with the patched
+one, and with the patched one inside `aevent.native()`.
+"""
+
+import sys
+import aevent, aevent._monkey
+aevent.setup(sys.argv[1] if len(sys.argv) > 1 else 'trio', exclude=('os',))
+
+import _socket
+import queue
+import socket
+import threading
+from timeit import timeit
+
+N = 100000
+
+def per_call(fn):
+    return timeit(fn, number=N) / N * 1e9
+
+def report(name, stdlib, patched):
+    t_orig = per_call(stdlib)
+    t_new = per_call(patched)
+    with aevent.native():
+        t_native = per_call(patched)
+    print("%-28s %8.0f ns %8.0f ns %8.0f ns" % (name, t_orig, t_new, t_native))
+
+def pair(cls):
+    l = cls()
+    l.bind(("127.0.0.1", 0))
+    l.listen()
+    a = cls()
+    a.connect(l.getsockname())
+    fd, _ = l._accept()
+    b = cls(fileno=fd)
+    l.close()
+    return a, b
+
+async def main():
+    print("%-28s %11s %11s %11s" % ("", "stdlib", "patched", "native()"))
+
+    lock = threading.Lock()
+    orig_lock = threading.Lock._aevent_orig()
+    def acq(lock):
+        lock.acquire()
+        lock.release()
+    report("Lock acquire+release", lambda: acq(orig_lock), lambda: acq(lock))
+
+    q = queue.Queue()
+    orig_q = queue.Queue._aevent_orig()
+    def put_get(q):
+        q.put(1)
+        q.get()
+    report("Queue put+get", lambda: put_get(orig_q), lambda: put_get(q))
+
+    a, b = pair(socket.socket)
+    orig_a, orig_b = pair(_socket.socket)
+    def send_recv(a, b):
+        a.send(b"x")
+        b.recv(10)
+    report("socket send+recv", lambda: send_recv(orig_a, orig_b), lambda: send_recv(a, b))
+
+aevent.run(main)
@@ -8,18 +8,124 @@ import sys
 import os
 
 from contextlib import asynccontextmanager, contextmanager
-from contextvars import ContextVar
+from _thread import get_ident as _get_ident, allocate_lock as _allocate_lock
+from contextvars import ContextVar, copy_context
 from functools import partial, update_wrapper
+from importlib import import_module
+from importlib.util import spec_from_loader
 from inspect import currentframe, iscoroutinefunction
-from outcome import Error, Value
+from types import coroutine
+from outcome import Error, Value, capture
+
+from . import _timeslice
+from ._timeslice import task_time
 
 _monkey = None
+_backend = None
+_spawn = None  # the original TaskGroup.spawn
 no_patch = ContextVar('no_patch', default=False)
 in_wrapper = ContextVar('in_wrapper', default=False)
 taskgroup = ContextVar('taskgroup')
 daemons = dict()  # taskgroup > set
 
-await_ = greenback.await_
+# Patches only apply in threads that run an event loop. Calls from other
+# (native) threads use the original code.
+_loop_threads = set()
+_loop_ident = None  # the thread that called `setup`; checked first
+_loop = None  # trio token or asyncio loop, for `from_thread`
+
+def _native_thread():
+    """
+    Return True if the current thread doesn't run an event loop.
+    """
+    ident = _get_ident()
+    return ident != _loop_ident and ident not in _loop_threads
+
+def await_(aw):
+    """
+    Run an awaitable from sync code.
+
+    A coroutine is stepped directly until it first suspends; only then is
+    it handed to `greenback.await_`. Operations which complete
+    immediately thus don't need a greenback portal, and are a lot faster.
+
+    In a native thread, the awaitable runs in a new task of the event
+    loop, via `from_thread`.
+    """
+    ident = _get_ident()
+    if ident != _loop_ident and ident not in _loop_threads:
+        return from_thread(_await_in_loop, aw)
+    return _await_in_loop(aw)
+
+def _await_in_loop(aw):
+    # `await_`, for callers which know that they run in the loop's thread
+    try:
+        send = aw.send
+    except AttributeError:
+        return greenback.await_(aw)
+    try:
+        yielded = send(None)
+    except StopIteration as exc:
+        return exc.value
+    return greenback.await_(_resume(aw, yielded))
+
+@coroutine
+def _resume(coro, yielded):
+    # Pass `yielded` on to the event loop, then continue running `coro`.
+    while True:
+        try:
+            sent = yield yielded
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as exc:
+            try:
+                yielded = coro.throw(exc)
+            except StopIteration as stop:
+                return stop.value
+        else:
+            try:
+                yielded = coro.send(sent)
+            except StopIteration as stop:
+                return stop.value
+
+def run_nowait(coro):
+    """
+    Run a coroutine which never suspends from sync code, without a round
+    trip through greenback. Returns its result.
+    """
+    if not hasattr(coro, "send"):
+        return coro  # not a coroutine after all (anyio 3)
+    try:
+        coro.send(None)
+    except StopIteration as exc:
+        return exc.value
+    coro.close()
+    raise RuntimeError("%r tried to suspend" % (coro,))
+
+def set_event(evt):
+    """
+    Set an anyio event from sync code.
+
+    anyio 2's ``Event.set`` is a coroutine which never suspends, so we can
+    simply run it to completion.
+
+    A native thread can't do that, so the event is set by a callback in
+    the event loop instead. Thus a waiter may find that it has been woken,
+    i.e. removed from its queue of waiters, before its event is set.
+    """
+    ident = _get_ident()
+    if ident != _loop_ident and ident not in _loop_threads:
+        _call_soon(set_event, evt)
+        return
+    run_nowait(evt.set())
+
+# Patched functions only look at `no_patch` after `native` or `patched`
+# has been used at least once. This can't be undone when the context
+# manager exits: tasks started within keep a copy of the context.
+# Code of our own that only runs in native threads, where patches are off
+# anyway, sets `no_patch` directly so that it doesn't trip this.
+_no_patch_used = False
 
 @contextmanager
 def native(val=True):
@@ -27,7 +133,9 @@ def native(val=True):
     A context manager that temporarily switches off all patches imposed by
     `aevent.setup`.
     """
-    t = no_patch.set(True)
+    global _no_patch_used
+    _no_patch_used = True
+    t = no_patch.set(val)
     try:
         yield None
     finally:
@@ -39,6 +147,113 @@ def patched():
     """
     return native(val=False)
 
+# The maximum number of native threads used by `to_thread`
+offload_threads = min(32, (os.cpu_count() or 1) + 4)
+_offload_limiter = None
+_offload_state = ContextVar('offload_state', default=None)
+
+class _OffloadState:
+    cancelled = False
+
+def _call_native(fn, args, kwargs, state):
+    # runs in the worker thread, within a copy of the caller's context
+    _offload_state.set(state)
+    no_patch.set(True)
+    return fn(*args, **kwargs)
+
+async def to_thread(fn, *args, **kwargs):
+    """
+    Run the sync function `fn` in a native worker thread, with all patches
+    switched off, and wait for the result.
+
+    Use this for CPU-bound code that releases the GIL, like compression or
+    hashing. At most `offload_threads` calls run at the same time.
+    Context variables are copied to the thread.
+
+    A running thread can't be interrupted. If the calling task is
+    cancelled, it stops waiting and `offload_cancelled` starts returning
+    True in the thread; the result is discarded.
+    """
+    global _offload_limiter
+    if _offload_limiter is None:
+        _offload_limiter = anyio.create_capacity_limiter(offload_threads)
+    state = _OffloadState()
+    ctx = copy_context()
+    try:
+        return await anyio.run_sync_in_worker_thread(
+            ctx.run, _call_native, fn, args, kwargs, state,
+            cancellable=True, limiter=_offload_limiter)
+    except anyio.get_cancelled_exc_class():
+        state.cancelled = True
+        raise
+
+def offload(fn):
+    """
+    A decorator for sync functions that should always run in a native
+    thread, via `to_thread`. The calling task waits cooperatively.
+
+    The function is called directly when patches are switched off, e.g.
+    when it's called from another offloaded function, and in native
+    threads, which may block anyway.
+    """
+    def _offload(*a, **k):
+        if _no_patch_used and no_patch.get() or _native_thread():
+            return fn(*a, **k)
+        return await_(to_thread(fn, *a, **k))
+    return update_wrapper(_offload, fn)
+
+def offload_cancelled():
+    """
+    In a function run by `to_thread`, return True if the caller is no
+    longer waiting for its result. Long-running code may check this
+    periodically and give up early.
+    """
+    state = _offload_state.get()
+    return state is not None and state.cancelled
+
+def from_thread(fn, *args, **kwargs):
+    """
+    Call the sync function `fn` in a new task of the event loop and wait
+    for its result. Use this in native threads which need to talk to the
+    loop's tasks, e.g. via a shared queue.
+
+    The event loop is woken up via its wakeup file descriptor, so this
+    doesn't poll.
+    """
+    loop = _loop
+    if loop is None:
+        raise RuntimeError("No event loop is running")
+    done = _allocate_lock()
+    done.acquire()
+    res = None
+
+    async def _run():
+        nonlocal res
+        try:
+            await per_task()
+            res = capture(fn, *args, **kwargs)
+        except BaseException as exc:
+            res = Error(exc)  # cancelled while starting up
+        finally:
+            done.release()
+
+    if _backend == 'trio':
+        loop.run_sync_soon(trio.lowlevel.spawn_system_task, _run)
+    else:
+        loop.call_soon_threadsafe(loop.create_task, _run())
+    done.acquire()
+    return res.unwrap()
+
+def _call_soon(fn, *args):
+    # Run `fn` in the event loop's thread. Don't wait for it.
+    loop = _loop
+    if loop is None:
+        raise RuntimeError("No event loop is running")
+    if _backend == 'trio':
+        loop.run_sync_soon(fn, *args)
+    else:
+        loop.call_soon_threadsafe(fn, *args)
+
 @asynccontextmanager
 async def runner():
     async with anyio.create_task_group() as tg:
@@ -65,16 +280,69 @@ def run(proc, *args, **kwargs):
             return await proc(*args, **kwargs)
     return anyio.run(_run)
 
+# The modules we replace, in the order in which they're loaded by `setup`
+_patched_modules = ('os', 'time', 'socket', 'queue', 'atexit', 'select',
+                    'selectors', 'threading', 'concurrent.futures')
+
+class _Finder:
+    """
+    A meta path finder which replaces the modules in `names` with our
+    patched versions when they are first imported.
+
+    The original module is loaded first, so that the patched one can
+    import from it.
+    """
+    def __init__(self, names):
+        self.names = set(names)
+        self.loading = set()
+
+    def find_spec(self, name, path=None, target=None):
+        if name not in self.names or name in self.loading:
+            return None
+        mm = sys.modules.get('aevent._monkey.'+name)
+        if mm is not None and getattr(mm.__spec__, '_initializing', False):
+            return None  # the patched module imports the original
+        return spec_from_loader(name, self)
+
+    def create_module(self, spec):
+        name = spec.name
+        self.loading.add(name)
+        try:
+            import_module(name)
+            mm = import_module('aevent._monkey.'+name)
+        finally:
+            self.loading.discard(name)
+        self.names.discard(name)
+        return mm
+
+    def exec_module(self, module):
+        pass
+
+    def install(self, name):
+        """
+        Replace the already-loaded module `name`.
+        """
+        mm = import_module('aevent._monkey.'+name)
+        self.names.discard(name)
+        sys.modules[name] = mm
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, mm)
+
 _setup_done = False
-def setup(backend='trio', exclude=()):
+def setup(backend='trio', exclude=(), timeslice=None):
     """
     Set up the aevent imports and patches.
 
-    This function changes core Python modules.
+    This function changes core Python modules. Those that have already
+    been imported are replaced immediately, the others on first import.
     It *must* be called before you import *anything else*.
 
     :param backend: The back-end to use, may be 'trio' or 'asyncio'.
     :param exclude: a set of modules that should not be patched.
+    :param timeslice: if set, sync code that runs for longer than this
+        many milliseconds without blocking yields to other tasks. This
+        must be called from the main thread. See `aevent._timeslice`.
 
     Supported modules:
     * time
@@ -92,7 +360,9 @@ def setup(backend='trio', exclude=()):
         raise RuntimeError("You're trying to mix backends")
 
     global _monkey
+    global _loop_ident
     global _backend
+    global _spawn
     global trio, asyncio
 
     if backend == 'trio':
@@ -105,24 +375,18 @@ def setup(backend='trio', exclude=()):
         raise RuntimeError("backend must be 'trio' or 'asyncio', not %r" % (backend),)
     _backend = backend
 
-    from . import _monkey
-
-    def import_mod(m):
-        if m in exclude:
-            mm = __import__(m, level=0) 
-            setattr(_monkey, m, mm)
-        else:
-            mm = __import__('aevent._monkey.'+m)
-            mm = getattr(mm._monkey, m)
-        sys.modules[m] = mm
-
-    import_mod('os')
-    import_mod('time')
-    import_mod('socket')
-    import_mod('queue')
-    import_mod('atexit')
-    import_mod('select')
-    import_mod('threading')
+    _monkey = import_module('aevent._monkey')
+    _loop_ident = _get_ident()
+    _loop_threads.add(_loop_ident)
+
+    # Modules that are already loaded are replaced now, the others when
+    # they're first imported.
+    finder = _Finder(m for m in _patched_modules if m not in exclude)
+    sys.meta_path.insert(0, finder)
+    for m in _patched_modules:
+        if m in finder.names and m in sys.modules:
+            finder.install(m)
+    _spawn = TG.spawn
     if 'spawn' not in exclude:
         _real_spawn = TG.spawn
         async def spawn(taskgroup, proc, *args, _aevent_name=None, **kw):
@@ -167,9 +431,12 @@ def setup(backend='trio', exclude=()):
             TR_call = TR.call
             TR_call_func = TR._call_func
             TR_close = TR.close
-            def _init(*a,**k):
-                with native():
-                    TR_init(*a,**k)
+            def _init(self, **k):
+                TR_init(self, **k)
+                # trio's I/O thread feeds this queue while the test's thread
+                # blocks on it, so it must be a native one
+                from queue import Queue
+                self._call_queue = getattr(Queue, "_aevent_orig", Queue)()
             async def _trio_main(self):
                 #in_wrapper.set(True)
                 await TR_trio_main(self)
@@ -224,6 +491,9 @@ def setup(backend='trio', exclude=()):
 
     sys.path[0:0] = [os.path.join(_monkey.__path__[0],"_monkey")]
 
+    if timeslice:
+        _timeslice.start(backend, timeslice)
+
 def F():
     sys.stdout.flush()
 
@@ -233,7 +503,14 @@ async def per_task():
 
     This is done for you if you use our patched version of ``anyio.TaskGroup.spawn``.
     """
+    global _loop
     await greenback.ensure_portal()
+    _timeslice.attach()
+    _loop_threads.add(_get_ident())
+    if _backend == 'trio':
+        _loop = trio.lowlevel.current_trio_token()
+    else:
+        _loop = asyncio.get_running_loop()
 
 async def _runner(proc, a, k):
     await per_task()
@@ -251,13 +528,16 @@ def patch_(fn, name=None, orig=None):
 
     If `fn` is a class, subclassing it no longer works.
 
+    The original is used when `no_patch` is True, and when the caller is a
+    native thread, i.e. one that doesn't run an event loop. That check is
+    done here, once per call, so the patched code doesn't need to repeat
+    it unless it's shared with native threads.
+
     The patched result has three attributes
     * _aevent_orig: the original function or class
-      used when `no_patch` is False
     * _aevent_new: the replaced function or class
-      used when `no_patch` is True
     * _aevent_select: a no-args function which, when called,
-      returns the old or new version based on `no_patch`
+      returns the old or new version
     """
 
     if isinstance(fn,partial):
@@ -267,18 +547,26 @@ def patch_(fn, name=None, orig=None):
     orig = orig or currentframe().f_back.f_globals[fname]
 
     def fn_select(orig, fn):
-        return orig if no_patch.get() else fn
+        ident = _get_ident()
+        if (ident != _loop_ident and ident not in _loop_threads
+                or _no_patch_used and no_patch.get()):
+            return orig
+        return fn
 
     def fn_async(orig, fn):
         def _new_async(*a, **k):
-            if no_patch.get():
+            ident = _get_ident()
+            if (ident != _loop_ident and ident not in _loop_threads
+                    or _no_patch_used and no_patch.get()):
                 return orig(*a, **k)
-            return greenback.await_(fn(*a, **k))
+            return _await_in_loop(fn(*a, **k))
         return _new_async
 
     def fn_sync(orig, fn):
         def _new_sync(*a, **k):
-            if no_patch.get():
+            ident = _get_ident()
+            if (ident != _loop_ident and ident not in _loop_threads
+                    or _no_patch_used and no_patch.get()):
                 return orig(*a, **k)
             return fn(*a, **k)
         return _new_sync
@@ -289,7 +577,7 @@ def patch_(fn, name=None, orig=None):
         w = update_wrapper(fn_sync(orig,fn), fn)
 
     w._aevent_orig = orig
-    w._aevent_new = orig
+    w._aevent_new = fn
     w._aevent_select = lambda: fn_select(orig, fn)
     return w
 
@@ -0,0 +1,217 @@
+"""
+Long-lived readiness watchers for file descriptors.
+
+anyio's `wait_socket_readable` and `wait_socket_writable` register the
+file descriptor with the event loop when they start waiting and remove it
+when they're done, which costs two system calls per wait on asyncio.
+
+This module doesn't help with trio. Its epoll backend registers file
+descriptors with EPOLLONESHOT and re-arms them with an `epoll_ctl(MOD)`
+call on every wait, and we can't change that from the outside, so there
+we simply call its waiting functions directly.
+
+With asyncio, the file descriptor stays registered with the loop's
+selector for as long as somebody keeps waiting on it, not for the
+watcher's whole lifetime. The selector is level-triggered, so when the
+callback fires without a waiter, i.e. when the owner is busy doing
+something else, it unregisters the descriptor and remembers that it's
+ready; otherwise it would fire on every pass through the loop. The next
+wait registers it again. `unwatch` removes any registration.
+"""
+
+import sniffio
+
+__all__ = ["watch", "wait_readable", "wait_writable"]
+
+
+class _TrioFdState:
+    """
+    Readiness of a file descriptor, trio version.
+    """
+    __slots__ = ('fd', 'readable', 'writable')
+
+    waiting = False
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def current(self):
+        return True
+
+    async def wait_readable(self):
+        try:
+            await trio.lowlevel.wait_readable(self.fd)
+        except trio.ClosedResourceError:
+            pass  # the caller's next operation will fail
+
+    async def wait_writable(self):
+        try:
+            await trio.lowlevel.wait_writable(self.fd)
+        except trio.ClosedResourceError:
+            pass
+
+    def wake(self):
+        pass
+
+    def unwatch(self):
+        try:
+            # this wakes up any waiters
+            trio.lowlevel.notify_closing(self.fd)
+        except RuntimeError:
+            pass  # not within trio.run
+
+
+class _AsyncioFdState:
+    """
+    Readiness of a file descriptor, asyncio version.
+
+    The `readable` and `writable` flags are set when the loop reports
+    readiness while nobody is waiting. The owner must clear them when an
+    operation would block, before waiting again.
+    """
+    __slots__ = ('fd', 'loop', 'readable', 'writable',
+            '_r_fut', '_w_fut', '_r_reg', '_w_reg')
+
+    def __init__(self, fd, loop):
+        self.fd = fd
+        self.loop = loop
+        self.readable = False
+        self.writable = False
+        self._r_fut = None
+        self._w_fut = None
+        self._r_reg = False
+        self._w_reg = False
+
+    @property
+    def waiting(self):
+        return self._r_fut is not None or self._w_fut is not None
+
+    def current(self):
+        return self.loop is asyncio._get_running_loop()
+
+    async def wait_readable(self):
+        if self.readable:
+            return
+        if self._r_fut is not None:
+            raise anyio.BusyResourceError('reading from')
+        fut = self._r_fut = self.loop.create_future()
+        if not self._r_reg:
+            self.loop.add_reader(self.fd, self._on_read)
+            self._r_reg = True
+        try:
+            await fut
+        finally:
+            self._r_fut = None
+
+    async def wait_writable(self):
+        if self.writable:
+            return
+        if self._w_fut is not None:
+            raise anyio.BusyResourceError('writing to')
+        fut = self._w_fut = self.loop.create_future()
+        if not self._w_reg:
+            self.loop.add_writer(self.fd, self._on_write)
+            self._w_reg = True
+        try:
+            await fut
+        finally:
+            self._w_fut = None
+
+    def _on_read(self):
+        fut = self._r_fut
+        if fut is None or fut.done():
+            self.loop.remove_reader(self.fd)
+            self._r_reg = False
+            self.readable = True
+        else:
+            fut.set_result(None)
+
+    def _on_write(self):
+        fut = self._w_fut
+        if fut is None or fut.done():
+            self.loop.remove_writer(self.fd)
+            self._w_reg = False
+            self.writable = True
+        else:
+            fut.set_result(None)
+
+    def wake(self):
+        """
+        Wake up all waiters, e.g. because the file descriptor is closed.
+        """
+        for fut in (self._r_fut, self._w_fut):
+            if fut is not None and not fut.done():
+                fut.set_result(None)
+
+    def unwatch(self):
+        """
+        Stop watching. Call this *before* closing the file descriptor.
+        """
+        if self.loop.is_closed():
+            return
+        if self._r_reg:
+            self.loop.remove_reader(self.fd)
+            self._r_reg = False
+        if self._w_reg:
+            self.loop.remove_writer(self.fd)
+            self._w_reg = False
+        self.wake()
+
+
+def watch(fd):
+    """
+    Return a readiness watcher for the file descriptor `fd`,
+    bound to the current event loop.
+    """
+    global trio, asyncio, anyio
+    if sniffio.current_async_library() == "trio":
+        import trio
+        return _TrioFdState(fd)
+    else:
+        import asyncio
+        import anyio
+        return _AsyncioFdState(fd, asyncio.get_running_loop())
+
+
+async def wait_readable(fd):
+    """
+    Wait once until the file descriptor `fd` is readable.
+
+    Raises `PermissionError` for file descriptors that can't be polled,
+    e.g. regular files.
+    """
+    if sniffio.current_async_library() == "trio":
+        import trio
+        await trio.lowlevel.wait_readable(fd)
+    else:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        loop.add_reader(fd, _wake, fut)
+        try:
+            await fut
+        finally:
+            loop.remove_reader(fd)
+
+
+async def wait_writable(fd):
+    """
+    Wait once until the file descriptor `fd` is writable.
+    """
+    if sniffio.current_async_library() == "trio":
+        import trio
+        await trio.lowlevel.wait_writable(fd)
+    else:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        loop.add_writer(fd, _wake, fut)
+        try:
+            await fut
+        finally:
+            loop.remove_writer(fd)
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
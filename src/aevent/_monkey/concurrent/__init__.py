@@ -0,0 +1 @@
+# dummy
@@ -0,0 +1,279 @@
+"""
+concurrent.futures, with a ThreadPoolExecutor that runs its work items
+as tasks in the current `aevent.runner`.
+"""
+
+import os as _os
+import anyio as _anyio
+import aevent as _aevent
+from aevent import patch_ as _patch, await_ as _await, \
+    set_event as _set_event, run_nowait as _run_nowait, taskgroup as _taskgroup
+from collections import deque as _deque
+from greenback import with_portal_run_sync as _with_portal_run_sync
+from itertools import count as _count
+from time import monotonic as _monotonic
+
+import concurrent.futures as _futures
+from concurrent.futures import Future, Executor, ThreadPoolExecutor, wait, as_completed, \
+    FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED, CancelledError, TimeoutError
+from concurrent.futures._base import DoneAndNotDoneFutures
+from concurrent.futures.thread import BrokenThreadPool
+
+# Let submodules (thread, process, …) and everything we don't replace
+# come from the original package.
+__path__ = _futures.__path__
+
+def __getattr__(name):
+    return getattr(_futures, name)
+
+
+class _Future(Future):
+    """
+    A future that waits cooperatively and can also be awaited.
+    """
+    _event = None  # created when somebody waits
+
+    def __await__(self):
+        return self._wait_result().__await__()
+
+    async def _wait_result(self):
+        if not self.done():
+            await self._wait(None)
+        return super().result(0)
+
+    async def _wait(self, timeout):
+        if self._event is None:
+            self._event = _anyio.create_event()
+        if timeout is None:
+            await self._event.wait()
+        else:
+            async with _anyio.move_on_after(timeout):
+                await self._event.wait()
+
+    def result(self, timeout=None):
+        if not self.done():
+            _await(self._wait(timeout))
+        return super().result(0)
+
+    def exception(self, timeout=None):
+        if not self.done():
+            _await(self._wait(timeout))
+        return super().exception(0)
+
+    def _invoke_callbacks(self):
+        evt = self._event
+        if evt is not None:
+            self._event = None
+            _set_event(evt)
+        super()._invoke_callbacks()
+
+
+@_patch
+class ThreadPoolExecutor(Executor):
+    """
+    An executor that runs work items as tasks.
+
+    At most `max_workers` work items run at the same time; the rest wait
+    in a queue, which each worker task drains before it exits.
+
+    With ``offload=True`` the work items run in native worker threads
+    instead, via `aevent.to_thread`. Use this for CPU-bound code.
+    """
+    _counter = _count().__next__
+
+    def __init__(self, max_workers=None, thread_name_prefix='',
+                 initializer=None, initargs=(), *, offload=False):
+        if max_workers is None:
+            max_workers = min(32, (_os.cpu_count() or 1) + 4)
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0")
+        if initializer is not None and not callable(initializer):
+            raise TypeError("initializer must be a callable")
+
+        self._max_workers = max_workers
+        self._thread_name_prefix = (thread_name_prefix or
+                                    ("ThreadPoolExecutor-%d" % self._counter()))
+        self._initializer = initializer
+        self._initargs = initargs
+        self._offload = offload
+
+        self._work_queue = _deque()  # (future, fn, args, kwargs)
+        self._n_workers = 0
+        self._n_running = 0
+        self._idle = None  # event, created by shutdown()
+        self._shutdown = False
+        self._broken = False
+
+    def submit(self, fn, *args, **kwargs):
+        if self._broken:
+            raise BrokenThreadPool(self._broken)
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+
+        f = _Future()
+        item = (f, fn, args, kwargs)
+        if self._n_running < self._max_workers:
+            self._n_running += 1
+            self._n_workers += 1
+            name = "%s_%d" % (self._thread_name_prefix, self._n_workers)
+            _run_nowait(_aevent._spawn(_taskgroup.get(), self._worker, item, name=name))
+        else:
+            self._work_queue.append(item)
+        return f
+    submit.__doc__ = Executor.submit.__doc__
+
+    async def _worker(self, item):
+        try:
+            if self._initializer is not None:
+                try:
+                    await self._call(self._initializer, self._initargs, {})
+                except Exception:
+                    self._initializer_failed(item)
+                    return
+            while True:
+                f, fn, args, kwargs = item
+                del item
+                if f.set_running_or_notify_cancel():
+                    try:
+                        res = await self._call(fn, args, kwargs)
+                    except Exception as exc:
+                        f.set_exception(exc)
+                    except BaseException as exc:
+                        f.set_exception(exc)
+                        raise
+                    else:
+                        f.set_result(res)
+                del f, fn, args, kwargs
+                if not self._work_queue:
+                    break
+                item = self._work_queue.popleft()
+        finally:
+            self._n_running -= 1
+            if not self._n_running and self._idle is not None:
+                _set_event(self._idle)
+
+    async def _call(self, fn, args, kwargs):
+        if self._offload:
+            return await _aevent.to_thread(fn, *args, **kwargs)
+        else:
+            return await _with_portal_run_sync(fn, *args, **kwargs)
+
+    def _initializer_failed(self, item):
+        self._broken = ('A thread initializer failed, the thread pool '
+                        'is not usable anymore')
+        while item is not None:
+            f = item[0]
+            if f.set_running_or_notify_cancel():
+                f.set_exception(BrokenThreadPool(self._broken))
+            item = self._work_queue.popleft() if self._work_queue else None
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._shutdown = True
+        if cancel_futures:
+            while self._work_queue:
+                self._work_queue.popleft()[0].cancel()
+        if wait and self._n_running:
+            if self._idle is None:
+                self._idle = _anyio.create_event()
+            _await(self._idle.wait())
+    shutdown.__doc__ = Executor.shutdown.__doc__
+
+
+class _Collector:
+    """
+    Collects futures as they finish.
+    """
+    def __init__(self, fs):
+        self.fs = fs
+        self.finished = _deque()
+        self.evt = None
+        for f in fs:
+            f.add_done_callback(self._done)
+
+    def _done(self, f):
+        self.finished.append(f)
+        evt = self.evt
+        if evt is not None:
+            self.evt = None
+            _set_event(evt)
+
+    def wait(self, deadline):
+        """
+        Wait until more futures have finished. Return False on timeout.
+        """
+        if not self.finished:
+            _await(self._wait(deadline))
+        return bool(self.finished)
+
+    async def _wait(self, deadline):
+        self.evt = evt = _anyio.create_event()
+        if deadline is None:
+            await evt.wait()
+        else:
+            async with _anyio.move_on_after(deadline - _monotonic()):
+                await evt.wait()
+
+    def close(self):
+        for f in self.fs:
+            try:
+                f._done_callbacks.remove(self._done)
+            except ValueError:
+                pass
+
+
+def _satisfied(done, not_done, return_when):
+    if not not_done:
+        return True
+    if return_when == FIRST_COMPLETED:
+        return bool(done)
+    if return_when == FIRST_EXCEPTION:
+        return any(not f.cancelled() and f.exception(0) is not None for f in done)
+    return False
+
+
+@_patch
+def wait(fs, timeout=None, return_when=ALL_COMPLETED):
+    fs = set(fs)
+    done = {f for f in fs if f.done()}
+    not_done = fs - done
+    if _satisfied(done, not_done, return_when):
+        return DoneAndNotDoneFutures(done, not_done)
+
+    deadline = None if timeout is None else _monotonic() + timeout
+    c = _Collector(not_done)
+    try:
+        while c.wait(deadline):
+            new = set()
+            while c.finished:
+                new.add(c.finished.popleft())
+            done |= new
+            not_done -= new
+            if _satisfied(new, not_done, return_when):
+                break
+    finally:
+        c.close()
+    return DoneAndNotDoneFutures(done, not_done)
+
+
+@_patch
+def as_completed(fs, timeout=None):
+    fs = set(fs)
+    total = len(fs)
+    deadline = None if timeout is None else _monotonic() + timeout
+    pending = {f for f in fs if not f.done()}
+    for f in fs - pending:
+        yield f
+    if not pending:
+        return
+
+    c = _Collector(pending)
+    try:
+        while pending:
+            if not c.wait(deadline):
+                raise TimeoutError('%d (of %d) futures unfinished' % (len(pending), total))
+            while c.finished:
+                f = c.finished.popleft()
+                pending.discard(f)
+                yield f
+    finally:
+        c.close()
@@ -1,13 +1,16 @@
-import anyio as _anyio
-import trio as _trio
+import errno as _errno
 from aevent import patch_ as _patch, await_ as _await
+from aevent._fdwatch import wait_readable as _wait_readable, wait_writable as _wait_writable
 
-from os import supports_dir_fd,supports_fd,supports_follow_symlinks
+from os import *
+from os import read as _read, write as _write, \
+    supports_dir_fd, supports_fd, supports_follow_symlinks
 import os as _os
 import sys  # yes, some standard modules actually need that.
 
-_read = read
-_write = write
+def __getattr__(name):
+    # private names, which `import *` doesn't copy
+    return getattr(_os, name)
 
 def _BadFD():
 	e = EnvironmentError()
@@ -16,12 +19,18 @@ def _BadFD():
 
 @_patch
 def read(fd, *args):
-    _await(_anyio.wait_socket_readable(fd))
+    try:
+        _await(_wait_readable(fd))
+    except PermissionError:
+        pass  # regular files can't be polled; they're always ready
     return _read(fd, *args)
 
 @_patch
 def write(fd, *args):
-    _await(_anyio.wait_socket_writable(fd))
+    try:
+        _await(_wait_writable(fd))
+    except PermissionError:
+        pass
     return _write(fd, *args)
 
 for k in dir(_os):
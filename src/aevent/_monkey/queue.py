@@ -1,91 +1,273 @@
 import anyio as _anyio
-import trio as _trio
-from aevent import patch_ as _patch, await_ as _await
+from aevent import patch_ as _patch, await_ as _await, set_event as _set_event, \
+	from_thread as _from_thread, _native_thread
+from collections import deque as _deque
+from heapq import heappush as _heappush, heappop as _heappop
+from time import monotonic as _monotonic
 
-from queue import Queue, Empty, Full
+from queue import Queue, LifoQueue, PriorityQueue, SimpleQueue, Empty, Full
 
-@_patch
-class Queue:
-	_size = 0
-	_q_r,_q_w = None,None
-	_count = 0
-	_count_unack = 0
-	_count_zero = None
+class _Waiting:
+	"""
+	Wait for, and wake up, tasks that are blocked on a queue.
+
+	Waiters park on an event in a deque. The event is popped by whoever
+	wakes them; a woken waiter re-checks its condition. A native thread's
+	wakeup is delivered by the event loop later, so a waiter that's no
+	longer in the deque has been woken even if its event isn't set.
+	"""
+	def _wake(self, waiters, n=1):
+		while n and waiters:
+			_set_event(waiters.popleft())
+			n -= 1
+
+	def _wait_for(self, waiters, ready, timeout, exc):
+		if timeout is not None and timeout < 0:
+			raise ValueError("'timeout' must be a non-negative number")
+		if not _await(self._wait(waiters, ready, timeout)):
+			raise exc
+
+	async def _wait(self, waiters, ready, timeout):
+		# Wait until `ready()` is true. Return False on timeout.
+		deadline = None if timeout is None else _monotonic() + timeout
+		while not ready():
+			evt = _anyio.create_event()
+			waiters.append(evt)
+			if ready():
+				# a native thread got here before we were queued
+				try:
+					waiters.remove(evt)
+				except ValueError:
+					self._wake(waiters)
+				return True
+			try:
+				if deadline is None:
+					await evt.wait()
+				else:
+					async with _anyio.move_on_after(deadline - _monotonic()):
+						await evt.wait()
+			except BaseException:
+				try:
+					waiters.remove(evt)
+				except ValueError:
+					# pass the wakeup on
+					self._wake(waiters)
+				raise
+			if not evt.is_set():
+				try:
+					waiters.remove(evt)
+				except ValueError:
+					continue  # woken by a native thread
+				return bool(ready())
+		return True
 
+
+class _Queue(_Waiting):
+	"""
+	The queue implementation.
+
+	Like the stdlib version, the storage is accessed via the _init, _qsize,
+	_put and _get methods, so that subclasses can change it.
+
+	Non-blocking calls, and blocking calls that don't need to wait,
+	never enter the event loop.
+
+	Native threads can use the queue to talk to tasks. When they need
+	to wait, the call runs in a task of the event loop instead, via
+	`aevent.from_thread`.
+	"""
 	def __init__(self, maxsize=0):
-		self._size = maxsize or 9999999
+		self.maxsize = maxsize
+		self._init(maxsize)
+		self._getters = _deque()
+		self._putters = _deque()
+		self.unfinished_tasks = 0
+		self._all_done = None
 
 	def qsize(self):
-		return self._count
+		return self._qsize()
+
+	def empty(self):
+		return not self._qsize()
+
+	def full(self):
+		return 0 < self.maxsize <= self._qsize()
+
+	def put(self, item, block=True, timeout=None):
+		if 0 < self.maxsize <= self._qsize():
+			if not block:
+				raise Full
+			if _native_thread():
+				return _from_thread(self.put, item, block, timeout)
+			self._wait_for(self._putters, self._has_room, timeout, Full)
+		self._put(item)
+		self.unfinished_tasks += 1
+		self._wake(self._getters)
+
+	def put_nowait(self, item):
+		return self.put(item, block=False)
 
 	def get(self, block=True, timeout=None):
-		return _await(self._get(block, timeout))
-	
+		if not self._qsize():
+			if not block:
+				raise Empty
+			if _native_thread():
+				return _from_thread(self.get, block, timeout)
+			self._wait_for(self._getters, self._qsize, timeout, Empty)
+		item = self._get()
+		self._wake(self._putters)
+		return item
+
 	def get_nowait(self):
-		return _await(self._get(False, 0))
-
-	async def _get(self, block, timeout):
-		if self._q_r is None:
-			self._q_w,self._q_r = _anyio.create_memory_object_stream(self._size)
-		if not block:
-			timeout = 0.1 # TODO
-		if timeout is None:
-			res = await self._q_r.receive()
-		else:
-			try:
-				async with _anyio.fail_after(timeout):
-					res = await self._q_r.receive()
-			except TimeoutError:
-				raise Empty from None
-		self._count -= 1
-		return res
+		return self.get(block=False)
 
+	def get_many(self, max_n, block=True, timeout=None):
+		"""
+		Remove and return a list of up to `max_n` items.
 
-	def put_nowait(self, item):
-		_await(self._put(item,0.1))  # TODO
-
-	def put(self, item, timeout=None):
-		_await(self._put(item,timeout))
-	
-	async def _put(self, item, block=True, timeout=None):
-		if self._q_r is None:
-			self._q_w,self._q_r = _anyio.create_memory_object_stream(self._size)
-
-		self._count += 1
-		self._count_unack += 1
-		if not block:
-			timeout = 0.1 # TODO
-		try:
-			if timeout is None:
-				await self._q_w.send(item)
-			else:
-				try:
-					async with _anyio.fail_after(timeout):
-						await self._q_w.send(item)
-				except TimeoutError:
-					raise Full from None
-		except BaseException:
-			self._count -= 1
-			await self._task_done()
-			raise
-
-	
-	def task_done(self):
-		_await(self._task_done())
+		This waits for at most one item, as `get` does.
+		"""
+		if not self._qsize():
+			if not block:
+				raise Empty
+			if _native_thread():
+				return _from_thread(self.get_many, max_n, block, timeout)
+			self._wait_for(self._getters, self._qsize, timeout, Empty)
+		n = min(max_n, self._qsize())
+		items = [self._get() for _ in range(n)]
+		self._wake(self._putters, n)
+		return items
 
-	async def _task_done(self):
-		if self._count_unack > 0:
-			self._count_unack -= 1
-		if self._count_unack == 0 and self._count_zero is not None:
-			await self._count_zero.set()
-	
+	def put_many(self, items, block=True, timeout=None):
+		"""
+		Put all of `items` into the queue.
+
+		If the queue is bounded, this waits for space as often as
+		necessary. If it can't (`block` is False or the timeout has been
+		reached), `Full` is raised; some items may have been queued.
+		"""
+		if self.maxsize > 0 and _native_thread():
+			# we might have to wait
+			return _from_thread(self.put_many, items, block, timeout)
+		deadline = None if timeout is None else _monotonic() + timeout
+		n = 0
+		for item in items:
+			if 0 < self.maxsize <= self._qsize():
+				self._wake(self._getters, n)
+				n = 0
+				if not block:
+					raise Full
+				self._wait_for(self._putters, self._has_room,
+						None if deadline is None else max(deadline - _monotonic(), 0), Full)
+			self._put(item)
+			self.unfinished_tasks += 1
+			n += 1
+		self._wake(self._getters, n)
+
+	def task_done(self):
+		if self.unfinished_tasks <= 0:
+			raise ValueError('task_done() called too many times')
+		self.unfinished_tasks -= 1
+		if not self.unfinished_tasks and self._all_done is not None:
+			_set_event(self._all_done)
+			self._all_done = None
 
 	def join(self):
-		_await(self._join())
-	
-	async def _join(self):
-		if self._count > 0:
-			if self._count_zero is None or self._count_zero.is_set():
-				self._count_zero = _anyio.create_event()
-			await self._count_zero.wait()
+		if self.unfinished_tasks:
+			if _native_thread():
+				return _from_thread(self.join)
+			evt = self._all_done
+			if evt is None:
+				evt = self._all_done = _anyio.create_event()
+				if not self.unfinished_tasks:
+					return  # a native thread didn't see the new event
+			_await(evt.wait())
+
+	def _has_room(self):
+		return self._qsize() < self.maxsize
+
+	# Override these methods to implement other queue organizations
+	# (e.g. stack or priority queue).
+
+	def _init(self, maxsize):
+		self.queue = _deque()
+
+	def _qsize(self):
+		return len(self.queue)
 
+	def _put(self, item):
+		self.queue.append(item)
+
+	def _get(self):
+		return self.queue.popleft()
+
+
+@_patch
+class Queue(_Queue):
+	pass
+
+
+@_patch
+class LifoQueue(_Queue):
+	def _init(self, maxsize):
+		self.queue = []
+
+	def _qsize(self):
+		return len(self.queue)
+
+	def _put(self, item):
+		self.queue.append(item)
+
+	def _get(self):
+		return self.queue.pop()
+
+
+@_patch
+class PriorityQueue(_Queue):
+	def _init(self, maxsize):
+		self.queue = []
+
+	def _qsize(self):
+		return len(self.queue)
+
+	def _put(self, item):
+		_heappush(self.queue, item)
+
+	def _get(self):
+		return _heappop(self.queue)
+
+
+@_patch
+class SimpleQueue(_Waiting):
+	"""
+	An unbounded FIFO queue without task tracking.
+	"""
+	def __init__(self):
+		self._queue = _deque()
+		self._getters = _deque()
+
+	def put(self, item, block=True, timeout=None):
+		# never blocks; the arguments are for compatibility with Queue
+		self._queue.append(item)
+		self._wake(self._getters)
+
+	def put_nowait(self, item):
+		return self.put(item, block=False)
+
+	def get(self, block=True, timeout=None):
+		if not self._queue:
+			if not block:
+				raise Empty
+			if _native_thread():
+				return _from_thread(self.get, block, timeout)
+			self._wait_for(self._getters, self._queue.__len__, timeout, Empty)
+		return self._queue.popleft()
+
+	def get_nowait(self):
+		return self.get(block=False)
+
+	def empty(self):
+		return not self._queue
+
+	def qsize(self):
+		return len(self._queue)
@@ -2,25 +2,156 @@ import anyio as _anyio
 import errno as _errno
 from aevent import patch_ as _patch, await_ as _await
 
-from select import poll,select,epoll, POLLIN,POLLOUT, POLLHUP,POLLERR,POLLRDHUP,POLLNVAL,POLLPRI
+from select import *
+from select import epoll as _epoll
+
+def _fileno(fd):
+    if not isinstance(fd, int):
+        fd = fd.fileno()
+    if fd < 0:
+        raise ValueError("file descriptor cannot be a negative integer (%d)" % (fd,))
+    return fd
+
+async def _wait(ep, timeout, maxevents=-1):
+    """
+    Wait for events on the native epoll object `ep`.
+
+    `timeout` is in seconds. None means "forever".
+    """
+    result = ep.poll(0, maxevents)
+    if result or (timeout is not None and timeout <= 0):
+        return result
+    if timeout is None:
+        while not result:
+            await _anyio.wait_socket_readable(ep)
+            result = ep.poll(0, maxevents)
+        return result
+    async with _anyio.move_on_after(timeout):
+        while not result:
+            await _anyio.wait_socket_readable(ep)
+            result = ep.poll(0, maxevents)
+    return result
 
 @_patch
-def epoll(*a,**kw):
-    raise NotImplementedError()
+class epoll:
+    """
+    A `select.epoll` replacement.
+
+    `poll` waits for the epoll object's file descriptor to become readable
+    instead of blocking in the kernel.
+    """
+    def __init__(self, sizehint=-1, flags=0):
+        self._ep = _epoll(sizehint, flags)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._ep.closed
+
+    def close(self):
+        self._ep.close()
+
+    def fileno(self):
+        return self._ep.fileno()
+
+    def register(self, fd, eventmask=EPOLLIN|EPOLLPRI|EPOLLOUT):
+        self._ep.register(fd, eventmask)
+
+    def modify(self, fd, eventmask):
+        self._ep.modify(fd, eventmask)
+
+    def unregister(self, fd):
+        self._ep.unregister(fd)
+
+    def poll(self, timeout=None, maxevents=-1):
+        if timeout is not None and timeout < 0:
+            timeout = None
+        return _await(_wait(self._ep, timeout, maxevents))
 
 @_patch
-def select(*a,**kw):
-    raise NotImplementedError()
+def select(rlist, wlist, xlist, timeout=None):
+    return _await(_select(rlist, wlist, xlist, timeout))
+
+async def _select(rlist, wlist, xlist, timeout):
+    if timeout is not None and timeout < 0:
+        raise ValueError("timeout must be non-negative")
+    masks = dict()
+    for fds,mask in ((rlist,EPOLLIN),(wlist,EPOLLOUT),(xlist,EPOLLPRI)):
+        for fd in fds:
+            fd = _fileno(fd)
+            masks[fd] = masks.get(fd,0) | mask
+    if not masks:
+        if timeout is None:
+            await _anyio.create_event().wait()
+        await _anyio.sleep(timeout)
+        return [],[],[]
+
+    # One temporary epoll object, one wait.
+    ready = dict()
+    ep = _epoll(len(masks))
+    try:
+        for fd,mask in masks.items():
+            try:
+                ep.register(fd, mask)
+            except PermissionError:
+                # regular files don't support epoll but are always ready
+                ready[fd] = mask
+        for fd,events in await _wait(ep, 0 if ready else timeout):
+            ready[fd] = events
+    finally:
+        ep.close()
+
+    def _ready(fds, mask):
+        return [fd for fd in fds if ready.get(_fileno(fd),0) & mask]
+    return (_ready(rlist, EPOLLIN|EPOLLHUP|EPOLLERR),
+            _ready(wlist, EPOLLOUT|EPOLLERR),
+            _ready(xlist, EPOLLPRI))
+
+# what poll reports for a regular file
+_FILE_EVENTS = POLLIN|POLLOUT|POLLRDNORM|POLLWRNORM
 
 @_patch
 class poll:
+    """
+    A `select.poll` replacement.
+
+    Registrations are kept in a private kernel epoll object. `poll` waits
+    for that object's file descriptor to become readable, then collects
+    the actual events in one system call.
+    """
     def __init__(self):
         self._mask = dict()
+        self._bad = set()
+        self._files = set()  # regular files, which epoll rejects
+        self._ep = _epoll()
 
     def register(self, fd, mask=POLLIN|POLLOUT):
         if hasattr(fd,"fileno"):
             fd = fd.fileno()
+        if fd in self._mask:
+            self.modify(fd, mask)
+            return
         self._mask[fd] = mask
+        if fd < 0:
+            self._bad.add(fd)
+            return
+        try:
+            self._ep.register(fd, mask)
+        except EnvironmentError as e:
+            if e.errno == _errno.EPERM:
+                # regular files are always ready, as in `select`
+                self._files.add(fd)
+                return
+            if e.errno != _errno.EBADF:
+                del self._mask[fd]
+                raise
+            # select.poll accepts these and reports POLLNVAL
+            self._bad.add(fd)
 
     def modify(self, fd, mask):
         if hasattr(fd,"fileno"):
@@ -28,57 +159,39 @@ class poll:
         if fd not in self._mask:
             raise FileNotFoundError(str(fd))
         self._mask[fd] = mask
+        if fd not in self._bad and fd not in self._files:
+            self._ep.modify(fd, mask)
 
     def unregister(self, fd):
         if hasattr(fd,"fileno"):
             fd = fd.fileno()
         del self._mask[fd]
+        if fd in self._bad:
+            self._bad.remove(fd)
+            return
+        if fd in self._files:
+            self._files.remove(fd)
+            return
+        try:
+            self._ep.unregister(fd)
+        except EnvironmentError as e:
+            # the kernel drops closed file descriptors by itself
+            if e.errno not in (_errno.EBADF, _errno.ENOENT):
+                raise
 
     def poll(self, timeout=None):
         return _await(self._poll(timeout))
 
     async def _poll(self, timeout):
-        # This is annoyingly inefficient.
-
-        result = []
-
-        async def fd_read(fd):
-            try:
-                await _anyio.wait_socket_readable(fd)
-            except EnvironmentError as e:
-                if e.errno == _errno.EBADF:
-                    result.append((fd,POLLNVAL))
-                else:
-                    raise
-            else:
-                result.append((fd,POLLIN|POLLHUP|POLLERR))
-            await ctx.cancel()
-
-        async def fd_write(fd):
-            try:
-                await _anyio.wait_socket_writable(fd)
-            except EnvironmentError as e:
-                if e.errno == _errno.EBADF:
-                    result.append((fd,POLLNVAL))
-                else:
-                    raise
-            else:
-                result.append((fd,POLLOUT))
-            await ctx.cancel()
-
-        async with _anyio.create_task_group() as tg:
-            ctx = tg.cancel_scope
-            for fd,mask in self._mask.items():
-                if fd == -1:
-                    result.append((fd,POLLNVAL))
-                    timeout=0.01
-                else:
-                    if mask&POLLIN:
-                        await tg.spawn(fd_read, fd)
-                    if mask&POLLOUT:
-                        await tg.spawn(fd_write, fd)
-            if timeout:
-                await anyio.sleep(timeout)
-                await ctx.cancel()
-        return result
-
+        # `timeout` is in milliseconds. None or <0 means "forever".
+        if self._bad or self._files:
+            res = [(fd,POLLNVAL) for fd in self._bad]
+            for fd in self._files:
+                events = self._mask[fd] & _FILE_EVENTS
+                if events:
+                    res.append((fd,events))
+            if res:
+                return res + self._ep.poll(0)
+        if timeout is not None:
+            timeout = timeout/1000 if timeout >= 0 else None
+        return await _wait(self._ep, timeout)
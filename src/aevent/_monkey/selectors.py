@@ -0,0 +1,95 @@
+from aevent import patch_ as _patch, await_ as _await
+import select as _select  # load (and patch) this first
+from aevent._monkey.select import _epoll, _wait, EPOLLIN as _EPOLLIN, EPOLLOUT as _EPOLLOUT
+
+import selectors as _selectors
+from selectors import *
+from selectors import _BaseSelectorImpl
+
+class _EpollSelector(_BaseSelectorImpl):
+    """
+    A selector that waits cooperatively.
+
+    Registrations are kept in a kernel epoll object for the lifetime of
+    the selector. `select` waits for that object's file descriptor to
+    become readable, then collects the events in one system call.
+    """
+    def __init__(self):
+        super().__init__()
+        self._selector = _epoll()
+
+    def fileno(self):
+        return self._selector.fileno()
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= _EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= _EPOLLOUT
+        return mask
+
+    def register(self, fileobj, events, data=None):
+        key = super().register(fileobj, events, data)
+        try:
+            self._selector.register(key.fd, self._mask(events))
+        except BaseException:
+            super().unregister(fileobj)
+            raise
+        return key
+
+    def unregister(self, fileobj):
+        key = super().unregister(fileobj)
+        try:
+            self._selector.unregister(key.fd)
+        except OSError:
+            # This can happen if the FD was closed since it
+            # was registered.
+            pass
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        try:
+            key = self._fd_to_key[self._fileobj_lookup(fileobj)]
+        except KeyError:
+            raise KeyError("%r is not registered" % (fileobj,)) from None
+        if (not events) or (events & ~(EVENT_READ | EVENT_WRITE)):
+            raise ValueError("Invalid events: %r" % (events,))
+
+        if events != key.events:
+            self._selector.modify(key.fd, self._mask(events))
+        elif data == key.data:
+            return key
+        key = key._replace(events=events, data=data)
+        self._fd_to_key[key.fd] = key
+        return key
+
+    def select(self, timeout=None):
+        if timeout is not None and timeout < 0:
+            timeout = 0
+        # epoll_wait() needs maxevents > 0
+        max_ev = max(len(self._fd_to_key), 1)
+
+        ready = []
+        for fd, event in _await(_wait(self._selector, timeout, max_ev)):
+            events = 0
+            if event & ~_EPOLLIN:
+                events |= EVENT_WRITE
+            if event & ~_EPOLLOUT:
+                events |= EVENT_READ
+
+            key = self._key_from_fd(fd)
+            if key:
+                ready.append((key, events & key.events))
+        return ready
+
+    def close(self):
+        self._selector.close()
+        super().close()
+
+# All of these would block, so they're all replaced with the same thing.
+EpollSelector = _patch(_EpollSelector, orig=_selectors.EpollSelector)
+PollSelector = _patch(_EpollSelector, orig=_selectors.PollSelector)
+SelectSelector = _patch(_EpollSelector, orig=_selectors.SelectSelector)
+DefaultSelector = _patch(_EpollSelector, orig=_selectors.DefaultSelector)
@@ -1,17 +1,40 @@
+import io as _io
 import os as _os
 import anyio as _anyio
-from aevent import patch_ as _patch, await_ as _await
+import aevent as _aevent
+from aevent import patch_ as _patch, _await_in_loop as _await, \
+	from_thread as _from_thread, _native_thread
+from aevent._fdwatch import watch as _watch
+from select import poll as _poll, POLLIN as _POLLIN, POLLOUT as _POLLOUT
+from time import monotonic as _monotonic
+from weakref import finalize as _finalize
 
+from socket import *
+from socket import socketpair as _socketpair
 from socket import socket as _socket, inet_pton, inet_ntop, AF_INET, \
 	AF_INET6, AF_UNSPEC, htons, ntohs, htonl, ntohl, inet_aton, inet_ntoa, \
 	SOCK_DGRAM, MSG_PEEK, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF, AF_UNIX, \
 	IPPROTO_TCP, SOCK_STREAM, AF_PACKET, SOCK_RAW, SO_REUSEADDR, \
-	SHUT_RDWR, IPPROTO_ICMP, IPPROTO_ICMPV6, IPPROTO_UDP, AI_PASSIVE, \
-	getprotobyname, _GLOBAL_DEFAULT_TIMEOUT
+	SHUT_RD, SHUT_WR, SHUT_RDWR, IPPROTO_ICMP, IPPROTO_ICMPV6, IPPROTO_UDP, AI_PASSIVE, \
+	getprotobyname, _GLOBAL_DEFAULT_TIMEOUT, _GiveupOnSendfile, \
+	timeout, getdefaulttimeout, setdefaulttimeout, SO_ERROR, gaierror, \
+	AI_NUMERICHOST, AI_NUMERICSERV, EAI_NONAME, \
+	getaddrinfo, gethostbyname, create_connection
+from socket import getaddrinfo as _getaddrinfo, timeout as _timeout_error
 
 error = OSError
 import errno # as _errno ## used as public API by too many
 from functools import partial as _partial
+from collections import OrderedDict as _OrderedDict
+from itertools import zip_longest as _zip_longest
+
+try:
+	_ExceptionGroup = ExceptionGroup
+except NameError:  # Python < 3.11
+	try:
+		from exceptiongroup import ExceptionGroup as _ExceptionGroup
+	except ImportError:
+		_ExceptionGroup = None
 
 class _Error:
 	def __getattribute__(self,key):
@@ -21,70 +44,401 @@ class _Error:
 _Error = _Error()
 
 class socket(_socket):
+	# Try the non-blocking syscall before waiting for the socket to become
+	# ready. Forcibly yield to the event loop every `_aevent_checkpoint`
+	# operations so that a busy socket can't starve other tasks.
+	_aevent_optimistic = True
+	_aevent_checkpoint = 32
+	_aevent_ops = 0
+	_aevent_rbuf = None
+	_aevent_watch = None
+	_aevent_fin = None
+	_aevent_timeout = None
+
 	def __init__(self,*args,**kwargs):
 		super().__init__(*args, **kwargs)
 		super().setblocking(False)
+		self._aevent_timeout = getdefaulttimeout()
+
+	# The socket itself is always non-blocking. Its timeout is applied to
+	# waiting for it instead.
+	def settimeout(self, timeout):
+		if timeout is _GLOBAL_DEFAULT_TIMEOUT:
+			timeout = getdefaulttimeout()
+		elif timeout is not None:
+			timeout = float(timeout)
+			if timeout < 0:
+				raise ValueError("Timeout value out of range")
+		self._aevent_timeout = timeout
+
+	def gettimeout(self):
+		return self._aevent_timeout
+
+	def setblocking(self, flag):
+		self._aevent_timeout = None if flag else 0.0
+
+	def getblocking(self):
+		return self._aevent_timeout != 0.0
+
+	def _deadline(self):
+		if self._aevent_timeout is None:
+			return None
+		return _monotonic() + self._aevent_timeout
 
-	def _wait_write(self):
-		if self.fileno() < 0:
-			raise _Error.EBADF
-		_await(_anyio.wait_socket_writable(self.fileno()))
-	def _wait_read(self):
-		if self.fileno() < 0:
-			raise _Error.EBADF
-		_await(_anyio.wait_socket_readable(self.fileno()))
+	def _watch(self):
+		# The socket keeps its fd watcher until it's closed, or collected
+		# without being closed. See aevent._fdwatch for what that means
+		# for the event loop's registration.
+		st = self._aevent_watch
+		if st is None or not st.current():
+			if self.fileno() < 0:
+				raise _Error.EBADF
+			if self._aevent_fin is not None:
+				self._aevent_fin.detach()
+			st = self._aevent_watch = _watch(self.fileno())
+			self._aevent_fin = _finalize(self, _unwatch_collected, st)
+		return st
+
+	def _unwatch(self):
+		st = self._aevent_watch
+		if st is None:
+			return
+		self._aevent_watch = None
+		self._aevent_fin.detach()
+		self._aevent_fin = None
+		if not _native_thread():
+			st.unwatch()
+			return
+		try:
+			_from_thread(st.unwatch)
+		except RuntimeError:
+			pass  # the event loop is gone
+
+	def _wait_write(self, blocked=False, deadline=None):
+		"""
+		Wait until the socket is writable.
+		Set `blocked` if that's because the last write would have blocked.
+		"""
+		if _native():
+			return _wait_native(self, _POLLOUT, deadline)
+		st = self._watch()
+		if blocked:
+			st.writable = False
+		if deadline is None:
+			_await(st.wait_writable())
+		else:
+			_await(_wait_until(st.wait_writable, deadline))
+	def _wait_read(self, blocked=False, deadline=None):
+		"""
+		Wait until the socket is readable.
+		Set `blocked` if that's because the last read would have blocked.
+		"""
+		if _native():
+			return _wait_native(self, _POLLIN, deadline)
+		st = self._watch()
+		if blocked:
+			st.readable = False
+		if deadline is None:
+			_await(st.wait_readable())
+		else:
+			_await(_wait_until(st.wait_readable, deadline))
+
+	def _real_close(self):
+		self._unwatch()
+		super()._real_close()
+
+	def detach(self):
+		self._unwatch()
+		return super().detach()
 
 	def connect(self, *args):
 		try:
 			super().connect(*args)
 		except BlockingIOError:
-			_await(_anyio.wait_socket_writable(self.fileno()))
+			if self._aevent_timeout == 0:
+				raise
+			self._wait_write(True, self._deadline())
 			try:
 				self.getpeername()
-			except EnvironmentError:
+			except EnvironmentError as exc:
 				if exc.errno == errno.ENOTCONN:
 					raise _Error.ECONNREFUSED
-	def accept(self, *args):
-		_await(_anyio.wait_socket_readable(self.fileno()))
-		sock,addr = super().accept(*args)
-		fd = _os.dup(sock.fileno())
-		nsock = type(self)(sock.family, sock.type, sock.proto, fileno=fd)
-		sock.close()
-		nsock.setblocking(False)
-		return nsock,addr
+	def accept(self):
+		fd,addr = self._io_read(_socket._accept)
+		return self._accepted(fd),addr
+
+	def accept_many(self, max_n=100):
+		"""
+		Wait for a connection, then accept up to `max_n` of them
+		without waiting again.
+
+		Returns a list of (socket, address) tuples.
+		"""
+		res = [self.accept()]
+		while len(res) < max_n:
+			try:
+				fd,addr = self._accept()
+			except BlockingIOError:
+				break
+			res.append((self._accepted(fd),addr))
+		return res
+
+	def _accepted(self, fd):
+		# wrap the new file descriptor directly, no dup() required
+		return type(self)(self.family, self.type, self.proto, fileno=fd)
+
+	def _io_read(self, fn, *args, deadline=None):
+		"""
+		Run the non-blocking read operation `fn`, waiting for the socket
+		to become readable only if it would block.
+
+		The socket's timeout applies to the whole operation, unless a
+		`deadline` is passed in.
+		"""
+		blocked = False
+		if self._aevent_optimistic or self._aevent_timeout == 0:
+			self._checkpoint()
+			try:
+				return fn(self, *args)
+			except BlockingIOError:
+				if self._aevent_timeout == 0:
+					raise
+				blocked = True
+		while True:
+			if deadline is None:
+				deadline = self._deadline()
+			self._wait_read(blocked, deadline)
+			try:
+				return fn(self, *args)
+			except BlockingIOError:
+				blocked = True
+
+	def _io_write(self, fn, *args, deadline=None):
+		"""
+		Run the non-blocking write operation `fn`, waiting for the socket
+		to become writable only if it would block.
+
+		The socket's timeout applies to the whole operation, unless a
+		`deadline` is passed in.
+		"""
+		blocked = False
+		if self._aevent_optimistic or self._aevent_timeout == 0:
+			self._checkpoint()
+			try:
+				return fn(self, *args)
+			except BlockingIOError:
+				if self._aevent_timeout == 0:
+					raise
+				blocked = True
+		while True:
+			if deadline is None:
+				deadline = self._deadline()
+			self._wait_write(blocked, deadline)
+			try:
+				return fn(self, *args)
+			except BlockingIOError:
+				blocked = True
+
+	def _checkpoint(self):
+		# A socket that always has data would never yield to the event
+		# loop, so force a checkpoint every so often.
+		self._aevent_ops += 1
+		if self._aevent_ops >= self._aevent_checkpoint:
+			self._aevent_ops = 0
+			if not _native():
+				_await(_anyio.sleep(0))
 
 	def send(self, *args):
-		_await(_anyio.wait_socket_writable(self.fileno()))
-		return super().send(*args)
+		return self._io_write(_socket.send, *args)
 	def sendto(self, *args):
-		self._wait_write()
-		return super().sendto(*args)
+		return self._io_write(_socket.sendto, *args)
 	def sendmsg(self, *args):
-		self._wait_write()
-		return super().sendmsg(*args)
+		return self._io_write(_socket.sendmsg, *args)
+	def sendall(self, data, flags=0):
+		deadline = self._deadline()
+		with memoryview(data) as view, view.cast("B") as view:
+			total = len(view)
+			sent = 0
+			while sent < total:
+				sent += self._io_write(_socket.send, view[sent:], flags, deadline=deadline)
+
+	def sendfile(self, file, offset=0, count=None):
+		try:
+			return self._sendfile_use_sendfile(file, offset, count)
+		except _GiveupOnSendfile:
+			return self._sendfile_use_send(file, offset, count)
+
+	def _sendfile_use_sendfile(self, file, offset=0, count=None):
+		# Like the stdlib version, except that it waits cooperatively
+		# instead of refusing to work on a non-blocking socket.
+		self._check_sendfile_params(file, offset, count)
+		try:
+			fileno = file.fileno()
+			fsize = _os.fstat(fileno).st_size
+		except (AttributeError, _io.UnsupportedOperation, OSError) as err:
+			raise _GiveupOnSendfile(err)  # not a regular file
+		if not fsize:
+			return 0  # empty file
+		# Truncate to 1GiB to avoid OverflowError, see bpo-38319.
+		blocksize = min(count or fsize, 2 ** 30)
+
+		total_sent = 0
+		try:
+			while True:
+				if count:
+					blocksize = count - total_sent
+					if blocksize <= 0:
+						break
+				try:
+					sent = self._io_write(_sendfile, fileno, offset, blocksize)
+				except (timeout, BlockingIOError):
+					raise  # send() would fail the same way
+				except OSError as err:
+					if total_sent == 0:
+						raise _GiveupOnSendfile(err)
+					raise
+				if sent == 0:
+					break  # EOF
+				offset += sent
+				total_sent += sent
+			return total_sent
+		finally:
+			if total_sent > 0 and hasattr(file, 'seek'):
+				file.seek(offset)
+
+	def _sendfile_use_send(self, file, offset=0, count=None):
+		self._check_sendfile_params(file, offset, count)
+		if offset:
+			file.seek(offset)
+		blocksize = min(count, 8192) if count else 8192
+		total_sent = 0
+		try:
+			while True:
+				if count:
+					blocksize = min(count - total_sent, blocksize)
+					if blocksize <= 0:
+						break
+				data = file.read(blocksize)
+				if not data:
+					break  # EOF
+				self.sendall(data)
+				total_sent += len(data)
+			return total_sent
+		finally:
+			if total_sent > 0 and hasattr(file, 'seek'):
+				file.seek(offset + total_sent)
+
 	def recv(self, *args):
-		self._wait_read()
-		return super().recv(*args)
+		return self._io_read(_socket.recv, *args)
 	def recvmsg(self, *args):
-		self._wait_read()
-		return super().recvmsg(*args)
+		return self._io_read(_socket.recvmsg, *args)
 	def recvfrom(self, *args):
-		self._wait_read()
-		return super().recvfrom(*args)
+		return self._io_read(_socket.recvfrom, *args)
 	def recv_into(self, *args):
-		self._wait_read()
-		return super().recv_into(*args)
+		return self._io_read(_socket.recv_into, *args)
 	def recvmsg_into(self, *args):
-		self._wait_read()
-		return super().recvmsg_into(*args)
+		return self._io_read(_socket.recvmsg_into, *args)
 	def recvfrom_into(self, *args):
-		self._wait_read()
-		return super().recvfrom_into(*args)
+		return self._io_read(_socket.recvfrom_into, *args)
 
-	def setblocking(self, flag):
-		super().setblocking(False)
+	def recv_batch(self, max_n=64, bufsize=2048):
+		"""
+		Wait for a datagram, then receive up to `max_n` of them
+		without waiting again. As with `recvfrom`, datagrams that are
+		longer than `bufsize` are truncated.
 
-for n in "getsockname getpeername getsockopt setsockopt close bind fileno listen gettimeout settimeout shutdown".split():
+		Returns a list of (data, address) tuples. The data are
+		memoryviews into a buffer that's owned by this socket and re-used
+		by the next call to `recv_batch`; copy them if you need to keep
+		them around.
+		"""
+		size = max_n * bufsize
+		if self._aevent_rbuf is None or len(self._aevent_rbuf) < size:
+			self._aevent_rbuf = memoryview(bytearray(size))
+		buf = self._aevent_rbuf
+
+		res = []
+		pos = 0
+		view = buf[pos:pos+bufsize]
+		n,_,_,addr = self._io_read(_socket.recvmsg_into, [view])
+		res.append((view[:n],addr))
+		while len(res) < max_n:
+			pos += bufsize
+			view = buf[pos:pos+bufsize]
+			try:
+				n,_,_,addr = _socket.recvmsg_into(self, [view])
+			except BlockingIOError:
+				break
+			res.append((view[:n],addr))
+		return res
+
+	def send_batch(self, items):
+		"""
+		Send a sequence of datagrams, given as (data, address) tuples.
+		Use None as the address if the socket is connected.
+
+		This only waits when the socket's send buffer is full.
+		Returns the number of datagrams sent. A non-blocking socket
+		only raises `BlockingIOError` if it couldn't send any of them.
+		"""
+		self._checkpoint()
+		deadline = self._deadline()
+		n = 0
+		for data,addr in items:
+			args = (data,) if addr is None else (data,addr)
+			fn = _socket.send if addr is None else _socket.sendto
+			while True:
+				try:
+					fn(self, *args)
+				except BlockingIOError:
+					if self._aevent_timeout == 0:
+						if n:
+							return n
+						raise
+					self._wait_write(True, deadline)
+				else:
+					break
+			n += 1
+		return n
+
+def _native():
+	# Native threads, and code that switched the patches off, can use our
+	# sockets too. They simply block.
+	return (_aevent._no_patch_used and _aevent.no_patch.get()) \
+		or _native_thread()
+
+def _wait_native(sock, events, deadline):
+	p = _poll()
+	p.register(sock, events)
+	if deadline is None:
+		p.poll()
+	elif not p.poll(max(deadline - _monotonic(), 0) * 1000):
+		raise timeout("timed out")
+
+def _unwatch_collected(st):
+	# The socket is gone and its fd is closed already, so the loop may
+	# as well do this later. Don't block in a finalizer.
+	if not _native_thread():
+		st.unwatch()
+		return
+	try:
+		_aevent._call_soon(st.unwatch)
+	except RuntimeError:
+		pass  # the event loop is gone
+
+async def _wait_until(fn, deadline):
+	try:
+		async with _anyio.fail_after(max(deadline - _monotonic(), 0)):
+			await fn()
+	except TimeoutError:
+		raise timeout("timed out") from None
+
+def _sendfile(sock, fileno, offset, blocksize):
+	return _os.sendfile(sock.fileno(), fileno, offset, blocksize)
+
+# makefile() uses SocketIO, which calls our recv_into and send.
+for n in ("getsockname getpeername getsockopt setsockopt close bind fileno listen "
+		"shutdown makefile").split():
 	setattr(socket,n,getattr(_socket,n))
 
 def _is_dead(n):
@@ -98,6 +452,167 @@ for n in dir(_socket):
 	fn = getattr(socket,n)
 	if not callable(fn):
 		continue
+	if n in socket.__dict__:
+		continue  # our version works natively too, see _native
 	setattr(socket, n, _patch(socket.__dict__.get(n,_is_dead(n)), name=n, orig=fn))
 
 del n
+
+
+@_patch
+def socketpair(family=AF_UNIX, type=SOCK_STREAM, proto=0):
+	a, b = _socketpair(family, type, proto)
+	return (socket(family, type, proto, fileno=a.detach()),
+			socket(family, type, proto, fileno=b.detach()))
+
+
+# Name resolution.
+#
+# Lookups run in a worker thread and are cached for `_dns_ttl` seconds,
+# as getaddrinfo doesn't tell us the real TTL. Numeric addresses are
+# handled directly.
+
+_dns_cache = _OrderedDict()
+_dns_cache_size = 1000
+_dns_ttl = 60
+_resolver = None
+
+def set_resolver(resolver):
+	"""
+	Consult `resolver` before the system's name resolution.
+
+	`resolver` is called with getaddrinfo's arguments and returns
+	getaddrinfo's result, or None to let the system handle the lookup.
+	It runs in the event loop and must not block; think "hosts file" or
+	"test fixture".
+
+	Pass None to remove the resolver. This also clears the cache.
+	"""
+	global _resolver
+	_resolver = resolver
+	_dns_cache.clear()
+
+@_patch
+async def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+	try:
+		return _getaddrinfo(host, port, family, type, proto, flags | AI_NUMERICHOST)
+	except gaierror as exc:
+		if exc.errno != EAI_NONAME or flags & AI_NUMERICHOST:
+			raise
+
+	key = (host, port, family, type, proto, flags)
+	try:
+		expires,res = _dns_cache[key]
+	except KeyError:
+		pass
+	else:
+		if expires > _monotonic():
+			_dns_cache.move_to_end(key)
+			return list(res)
+		del _dns_cache[key]
+
+	res = None
+	if _resolver is not None:
+		res = _resolver(*key)
+	if res is None:
+		res = await _anyio.run_sync_in_worker_thread(_getaddrinfo, *key, cancellable=True)
+
+	_dns_cache[key] = (_monotonic() + _dns_ttl, res)
+	_dns_cache.move_to_end(key)
+	while len(_dns_cache) > _dns_cache_size:
+		_dns_cache.popitem(last=False)
+	return list(res)
+
+@_patch
+async def gethostbyname(host):
+	res = await getaddrinfo.__wrapped__(host, None, AF_INET, SOCK_STREAM)
+	return res[0][4][0]
+
+# RFC 8305 says 250 msec.
+_connect_delay = 0.25
+
+@_patch
+async def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT,
+		source_address=None, *, all_errors=False):
+	"""
+	Connect to `address`, "happy eyeballs" style: when there are multiple
+	addresses, start a new attempt every 250 msec (or whenever the
+	previous attempt fails) and use whichever connects first.
+
+	With `all_errors`, failures are reported as an ExceptionGroup. Before
+	Python 3.11 that needs the `exceptiongroup` package; without it the
+	last error is raised, as it is by default.
+	"""
+	host, port = address
+	addrs = await getaddrinfo.__wrapped__(host, port, 0, SOCK_STREAM)
+	if not addrs:
+		raise error("getaddrinfo returns an empty list")
+
+	# Interleave address families, starting with the first one returned.
+	families = dict()
+	for res in addrs:
+		families.setdefault(res[0], []).append(res)
+	addrs = [res for group in _zip_longest(*families.values())
+			for res in group if res is not None]
+
+	if timeout is _GLOBAL_DEFAULT_TIMEOUT:
+		timeout = getdefaulttimeout()
+	try:
+		if timeout is None:
+			sock,errors = await _happy_eyeballs(addrs, source_address)
+		else:
+			async with _anyio.fail_after(timeout):
+				sock,errors = await _happy_eyeballs(addrs, source_address)
+	except TimeoutError:
+		raise _timeout_error("timed out") from None
+
+	if sock is None:
+		if all_errors and _ExceptionGroup is not None:
+			raise _ExceptionGroup("create_connection failed", errors)
+		raise errors[-1]
+	sock.settimeout(timeout)
+	return sock
+
+async def _happy_eyeballs(addrs, source_address):
+	winner = None
+	errors = []
+
+	async def attempt(res, failed):
+		nonlocal winner
+		try:
+			sock = await _connect(res, source_address)
+		except OSError as exc:
+			errors.append(exc)
+			await failed.set()
+			return
+		if winner is None:
+			winner = sock
+			await tg.cancel_scope.cancel()
+		else:
+			sock.close()
+
+	async with _anyio.create_task_group() as tg:
+		for res in addrs:
+			failed = _anyio.create_event()
+			await tg.spawn(attempt, res, failed)
+			async with _anyio.move_on_after(_connect_delay):
+				await failed.wait()
+	return winner,errors
+
+async def _connect(res, source_address):
+	af, socktype, proto, _, sa = res
+	sock = socket(af, socktype, proto)
+	try:
+		if source_address:
+			sock.bind(source_address)
+		try:
+			_socket.connect(sock, sa)
+		except BlockingIOError:
+			await sock._watch().wait_writable()
+			err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+			if err:
+				raise OSError(err, _os.strerror(err))
+	except BaseException:
+		sock.close()
+		raise
+	return sock
@@ -1,18 +1,29 @@
 import anyio as _anyio
-import sniffio as _sniffio
+import aevent as _aevent
 from aevent import patch_ as _patch, await_ as _await, \
-	taskgroup as _taskgroup, daemons as _daemons
+	set_event as _set_event, run_nowait as _run_nowait, \
+	taskgroup as _taskgroup, daemons as _daemons, \
+	from_thread as _from_thread
+from _thread import get_ident as _get_ident
+from greenback import with_portal_run_sync as _with_portal_run_sync
 import os as _os
 from collections import deque as _deque
+from heapq import heappush as _heappush, heappop as _heappop
+from time import monotonic as _monotonic
 
 from threading import current_thread, Lock, RLock, Event, Thread, \
 		_shutdown, active_count, get_ident, \
-		main_thread, Condition, Barrier
+		main_thread, Condition, Barrier, Semaphore, BoundedSemaphore, Timer
 try:
     from threading import excepthook
 except ImportError:
     def excepthook(x):
         raise x.exc_value
+try:
+    # used by concurrent.futures.thread
+    from threading import _register_atexit
+except ImportError:
+    pass
 try:
     from threading import get_native_id
 except ImportError:
@@ -20,95 +31,248 @@ except ImportError:
 
 from contextvars import ContextVar
 
+_orig_Thread = Thread
 
-from aevent.local import local
+def _native():
+	# Patches are switched off, or this is a native thread.
+	return (_aevent._no_patch_used and _aevent.no_patch.get()) \
+		or _aevent._native_thread()
 
-class _Lock_Common:
-	async def _acquire(self, timeout, me=None):
-		if self._lock is None:
-			self._lock = _anyio.create_lock()
-		if timeout < 0:
-			await self._lock.acquire()
-		else:
-			try:
-				async with _anyio.fail_after(timeout):
-					await self._lock.acquire()
-			except TimeoutError:
-				return False
-		if me is not None:
-			self._owner = me
-		return True
 
-	async def _release(self):
-		if _sniffio.current_async_library() == "trio":
-			import trio
-			self._lock._lock._owner = trio.lowlevel.current_task()
-		await self._lock.release()
+from aevent.local import local
 
-	def __enter__(self):
-		self.acquire()
-	def __exit__(self, *tb):
-		self.release()
-	async def __aenter__(self):
-		if self._lock is None:
-			self._lock = _anyio.create_lock()
-		return await self._lock.__aenter__()
-	async def __aexit__(self, *tb):
-		return await self._lock.__aexit__(*tb)
+if _aevent._backend == "trio":
+	from trio.lowlevel import current_task as _current_task
+else:
+	from asyncio import current_task as _current_task
 
+def _current_owner():
+	# Threads are tasks, so that's what owns a lock. Native threads are
+	# identified by their thread ID.
+	try:
+		return _current_task() or _root_thread
+	except RuntimeError:
+		return _get_ident()  # not running in a task
 
 @_patch
-class Lock(_Lock_Common):
-	_lock = None
+class Lock:
+	"""
+	A lock whose uncontended path is a simple flag check.
+
+	Waiters queue up in FIFO order. `release` hands ownership directly to
+	the first waiter.
+
+	Native threads can use the lock too, as can they use the other
+	primitives in this module. Their fast paths are the same; only when
+	they need to wait, `aevent.await_` does that in a task of the event
+	loop. When they wake a waiter, its event is set by the loop a bit
+	later, so a waiter that has been removed from the queue must assume
+	it's been woken up even if its event isn't set yet.
+	"""
 	def __init__(self):
-		pass
+		self._locked = False
+		self._waiters = None  # deque of events, created on contention
+
+	def __repr__(self):
+		return "<%s %s object at %#x>" % ("locked" if self._locked else "unlocked",
+				type(self).__name__, id(self))
+
+	def locked(self):
+		return self._locked
 
 	def acquire(self, blocking=True, timeout=-1):
+		if not self._locked:
+			self._locked = True
+			return True
 		if not blocking:
-			timeout = 0.001
-			# XXX use nowait instead
-		return _await(self._acquire(timeout))
+			if timeout != -1:
+				raise ValueError("can't specify a timeout for a non-blocking call")
+			return False
+		return _await(self._acquire_wait(timeout))
+
+	async def _acquire_wait(self, timeout):
+		if self._waiters is None:
+			self._waiters = _deque()
+		evt = _anyio.create_event()
+		self._waiters.append(evt)
+		if not self._locked:
+			# released by a native thread before we were queued
+			self._locked = True
+			self._waiters.remove(evt)
+			return True
+		try:
+			if timeout < 0:
+				await evt.wait()
+			else:
+				async with _anyio.move_on_after(timeout):
+					await evt.wait()
+		except BaseException:
+			try:
+				self._waiters.remove(evt)
+			except ValueError:
+				# We got the lock but can't use it.
+				self.release()
+			raise
+		if evt.is_set():
+			return True
+		try:
+			self._waiters.remove(evt)
+		except ValueError:
+			return True  # woken by a native thread
+		return False
 
 	def release(self):
 		# threading.Lock has no protection against releasing by the wrong task
-		_await(self._release())
+		if not self._locked:
+			raise RuntimeError("release unlocked lock")
+		if self._waiters:
+			# The lock stays locked; the first waiter now owns it.
+			_set_event(self._waiters.popleft())
+		else:
+			self._locked = False
 
+	def __enter__(self):
+		return self.acquire()
+	def __exit__(self, *tb):
+		self.release()
+	async def __aenter__(self):
+		if not self._locked:
+			self._locked = True
+		else:
+			await self._acquire_wait(-1)
+	async def __aexit__(self, *tb):
+		self.release()
+
+	# used by Condition
+	def _is_owned(self):
+		# Like the stdlib, we can't tell who holds a plain lock.
+		return self._locked
+
+	def _at_fork_reinit(self):
+		self._locked = False
+		self._waiters = None
 
-@_patch
-class RLock(_Lock_Common):
-	_lock = None
-	_count = 0
-	_owner = None
 
+@_patch
+class RLock:
+	"""
+	A reentrant lock.
+
+	The owner is the current task, or the thread ID of a native thread.
+	Reentrant acquisition only bumps a counter; the final `release`
+	hands ownership directly to the first waiter.
+	"""
 	def __init__(self):
-		pass
+		self._owner = None
+		self._count = 0
+		self._waiters = None  # deque of (event, task), created on contention
+
+	def __repr__(self):
+		return "<%s %s object owner=%r count=%d at %#x>" % (
+				"locked" if self._owner is not None else "unlocked",
+				type(self).__name__, self._owner, self._count, id(self))
 
 	def acquire(self, blocking=True, timeout=-1):
-		if self._lock is None:
-			self._lock = _anyio.create_lock()
-		me = current_thread()
+		me = _current_owner()
 		if self._owner == me:
 			self._count += 1
-			return
+			return True
+		if self._owner is None:
+			self._owner = me
+			self._count = 1
+			return True
 		if not blocking:
-			timeout = 0.001
-			# XXX use nowait instead
-		_await(self._acquire(timeout, me))
+			if timeout != -1:
+				raise ValueError("can't specify a timeout for a non-blocking call")
+			return False
+		return _await(self._acquire_wait(me, timeout))
+
+	async def _acquire_wait(self, me, timeout):
+		if self._waiters is None:
+			self._waiters = _deque()
+		evt = _anyio.create_event()
+		entry = (evt, me)
+		self._waiters.append(entry)
+		if self._owner is None:
+			# released by a native thread before we were queued
+			self._owner = me
+			self._count = 1
+			self._waiters.remove(entry)
+			return True
+		try:
+			if timeout < 0:
+				await evt.wait()
+			else:
+				async with _anyio.move_on_after(timeout):
+					await evt.wait()
+		except BaseException:
+			try:
+				self._waiters.remove(entry)
+			except ValueError:
+				# We got the lock but can't use it. We may be running
+				# on behalf of a native thread, so don't check the owner.
+				self._hand_off()
+			raise
+		if evt.is_set():
+			return True
+		try:
+			self._waiters.remove(entry)
+		except ValueError:
+			return True  # woken by a native thread
+		return False
 
 	def release(self):
-		me = current_thread()
-		if self._owner != me:
-			raise RuntimeError("Lock crash %r %r",self._owner,me)
-		if self._count:
-			self._count -= 1
-			return
-		self._owner = None
-		_await(self._release())
+		if self._owner != _current_owner():
+			raise RuntimeError("cannot release un-acquired lock")
+		self._count -= 1
+		if not self._count:
+			self._hand_off()
+
+	def _hand_off(self):
+		# The lock is free. Pass it on to the first waiter, if any.
+		if self._waiters:
+			evt, self._owner = self._waiters.popleft()
+			self._count = 1
+			_set_event(evt)
+		else:
+			self._owner = None
 
 	def __enter__(self):
-		self.acquire()
+		return self.acquire()
 	def __exit__(self, *tb):
 		self.release()
+	async def __aenter__(self):
+		me = _current_owner()
+		if self._owner == me:
+			self._count += 1
+		elif self._owner is None:
+			self._owner = me
+			self._count = 1
+		else:
+			await self._acquire_wait(me, -1)
+	async def __aexit__(self, *tb):
+		self.release()
+
+	# used by Condition
+	def _is_owned(self):
+		return self._owner == _current_owner()
+
+	def _release_save(self):
+		if self._owner != _current_owner():
+			raise RuntimeError("cannot release un-acquired lock")
+		count = self._count
+		self._count = 1
+		self.release()
+		return count
+
+	def _acquire_restore(self, count):
+		self.acquire()
+		self._count = count
+
+	def _at_fork_reinit(self):
+		self._owner = None
+		self._count = 0
+		self._waiters = None
 
 class _ThreadExc:
 	def __init__(self,exc,thread):
@@ -117,15 +281,55 @@ class _ThreadExc:
 		self.exc_traceback = getattr(exc,'__traceback__',None)
 		self.thread = thread
 
+class _Daemon:
+	"""
+	A daemon's entry in the runner's set of daemons.
+
+	It's added when the daemon is started, not when its task first runs,
+	so that a runner that exits right away still finds it. If it's
+	cancelled before the task runs, the task does nothing.
+	"""
+	def __init__(self, daemons):
+		self.daemons = daemons
+		self.scope = None
+		self.killed = False
+		daemons.add(self)
+
+	async def run(self, proc, *args):
+		try:
+			async with _anyio.open_cancel_scope() as sc:
+				self.scope = sc
+				if not self.killed:
+					await proc(*args)
+		finally:
+			self.daemons.discard(self)
+			self.scope = None
+
+	async def cancel(self):
+		# called by the runner on exit
+		self.killed = True
+		if self.scope is not None:
+			await self.scope.cancel()
+
 class _Thread:
+	"""
+	A thread, i.e. a task in the current `aevent.runner` task group.
+
+	Starting a thread spawns its task directly, without waiting for it
+	to come up. The greenback portal only lives while `run` executes,
+	and daemon threads are the only ones that need a cancel scope.
+	"""
 	_th_id = None
 	_tg = None
-	_ctx = None
+	_ctx = None  # the daemon's _Daemon entry
+	_thread = None  # the real thread, if started natively
 	_daemon = False
-	_daemons = None
+	_started = False
+	_finished = False
+	_done = None  # created by `join`
 
 	def __init__(self, group=None, target=None, name=None, 
-			args=(), kwargs={}, *, daemon=None):
+			args=(), kwargs=None, *, daemon=None):
 
 		global _th_id
 		_th_id += 1
@@ -133,8 +337,7 @@ class _Thread:
 
 		self._target = target
 		self._args = args
-		self._kwargs = kwargs
-		self._done = _anyio.create_event()
+		self._kwargs = kwargs if kwargs is not None else {}
 		self.name = name or "task_%d" % (self._th_id,)
 
 		if daemon is None:
@@ -148,70 +351,104 @@ class _Thread:
 
 	@property
 	def ident(self):
-		return self._th_id
+		return self._th_id if self._started else None
 
 	def is_alive(self):
-		return self._done is not None and not self._done.is_set()
+		return self._started and not self._finished
 
 
 	def start(self):
-		_await(self._start())
-
-	async def _start(self):
+		if _native():
+			self._start_native()
+			return
+		tg = self._prepare()
+		_run_nowait(_aevent._spawn(tg, self._bootstrap, name=self.name))
+
+	def _start_native(self):
+		# There's no task group to spawn a task in, so run in a real thread.
+		if self._started:
+			raise RuntimeError("threads can only be started once")
+		self._thread = _orig_Thread(target=self._run_native,
+				name=self.name, daemon=self._daemon)
+		self._started = True
 		_active_threads.add(self)
+		self._thread.start()
+
+	def _run_native(self):
+		try:
+			self.run()
+		finally:
+			self._finish()
+
+	def _prepare(self):
+		if self._started:
+			raise RuntimeError("threads can only be started once")
 		self._tg = tg = _taskgroup.get()
-		self._daemons = _daemons[tg]
-		up = _anyio.create_event()
-		self._ctx = await tg.spawn(self._run, up, _aevent_name=self.name)
 		if self._daemon:
-			self._daemons.add(self._ctx)
-		await up.set()
+			self._ctx = _Daemon(_daemons[tg])
+		self._started = True
+		_active_threads.add(self)
+		return tg
 
 	@property
 	def daemon(self):
 		return self._daemon
 	@daemon.setter
 	def daemon(self, flag):
-		if self._daemon == flag:
-			return
+		if self._started:
+			raise RuntimeError("cannot set daemon status of active thread")
 		self._daemon = flag
-		if self._daemons is None:
-			return
-		if flag:
-			self._daemons.add(self._ctx)
-		else:
-			self._daemons.remove(self._ctx)
 
-	async def _run(self, evt):
-		await evt.wait()
-		self.run(evt)
+	async def _bootstrap(self):
+		_this_thread.set(self)
+		try:
+			if self._ctx is not None:
+				await self._ctx.run(_with_portal_run_sync, self._run)
+			else:
+				await _with_portal_run_sync(self._run)
+		finally:
+			self._finish()
 
-	def run(self, evt):
+	def _run(self):
 		try:
-			if self._target:
-				self._target(*self._args, **self._kwargs)
+			self.run()
 		except Exception as exc:
 			excepthook(_ThreadExc(exc,self))
-		finally:
-			_await(self._done.set())
-			_active_threads.remove(self)
-			if self._daemon:
-				self._daemons.remove(self._ctx)
-
-			del self._daemons
 
-	def join(self, timeout=-1):
+	def run(self):
+		try:
+			if self._target:
+				self._target(*self._args, **self._kwargs)
+		finally:
+			del self._target, self._args, self._kwargs
+
+	def _finish(self):
+		self._finished = True
+		_active_threads.discard(self)
+		if self._done is not None:
+			_set_event(self._done)
+
+	def join(self, timeout=None):
+		if not self._started:
+			raise RuntimeError("cannot join thread before it is started")
+		if self._thread is not None and _native():
+			self._thread.join(timeout)
+			return
+		if current_thread() is self:
+			raise RuntimeError("cannot join current thread")
+		if self._finished:
+			return
+		if self._done is None:
+			self._done = _anyio.create_event()
+			if self._finished:
+				return  # a native thread finished just now
 		_await(self._join(timeout))
 
-	async def _join(self,timeout):
-		if current_thread() is self:
-			raise RuntimeError("tried to join myself")
-		if self._ctx is None:
-			raise RuntimeError("not yet started")
-		if timeout<0:
+	async def _join(self, timeout):
+		if timeout is None:
 			await self._done.wait()
 		else:
-			async with _anyio.fail_after(timeout):
+			async with _anyio.move_on_after(timeout):
 				await self._done.wait()
 
 	def setDaemon(self, flag):
@@ -233,16 +470,40 @@ def excepthook(k):
 
 class RootThread(_Thread):
 	_th_id = 1
-	daemon = False
+	_started = True
+	name = "MainThread"
 	def __init__(self):
 		pass # do not call super()
 	pass
 
-Thread = _patch(_Thread)
+class Thread(_Thread):
+	"""
+	A thread.
+
+	Unlike the other classes in this module, this is a real class, so
+	it can be subclassed. Native threads, and code that switched the
+	patches off, get the original `threading.Thread` when they create
+	one, but not when they create an instance of a subclass. When they
+	start such an instance, its `run` method executes in a real thread.
+	"""
+	_aevent_orig = _orig_Thread
+
+	def __new__(cls, *args, **kwargs):
+		if cls is Thread and _native():
+			return _orig_Thread(*args, **kwargs)
+		return super().__new__(cls)
+
+	@staticmethod
+	def _aevent_select():
+		if _native():
+			return _orig_Thread
+		return Thread
+
+Thread._aevent_new = Thread
 
 _root_thread = RootThread()
 _th_id = 1
-_this_thread = ContextVar("_this_thread", default=RootThread())
+_this_thread = ContextVar("_this_thread", default=_root_thread)
 _active_threads = set()
 
 @_patch
@@ -262,10 +523,16 @@ def main_thread():
 	return _root_thread
 
 
-# This is almost a straight copy from `threading`.
-
 @_patch
 class Condition:
+	"""
+	A condition variable.
+
+	Waiters are kept in insertion order in a dict, so that adding,
+	removing and waking one of them is O(1). `notify_all` wakes the
+	current generation of waiters in a single pass; tasks that start
+	waiting while it runs belong to the next one.
+	"""
 	def __init__(self, lock=None):
 		if lock is None:
 			lock = RLock()
@@ -273,7 +540,12 @@ class Condition:
 		# Export the lock's acquire() and release() methods
 		self.acquire = lock.acquire
 		self.release = lock.release
-		self._waiters = _deque()
+		for name in ('_is_owned', '_release_save', '_acquire_restore'):
+			try:
+				setattr(self, name, getattr(lock, name))
+			except AttributeError:
+				pass
+		self._waiters = {}
 
 	def __enter__(self):
 		return self._lock.__enter__()
@@ -299,30 +571,53 @@ class Condition:
 		else:
 			return True
 
-	async def _wait(self, timeout):
+	def _release_save(self):
+		self._lock.release()
+
+	def _acquire_restore(self, x):
+		self._lock.acquire()
+
+	def wait(self, timeout=None):
 		if not self._is_owned():
 			raise RuntimeError("cannot wait on un-acquired lock")
+		if _aevent._native_thread():
+			# The waiter must be queued before we release the lock, but
+			# native threads can't create the loop's events.
+			waiter = _from_thread(self._add_waiter)
+		else:
+			waiter = self._add_waiter()
+		saved = self._release_save()
+		try:
+			return _await(self._wait(waiter, timeout))
+		finally:
+			self._acquire_restore(saved)
+
+	def _add_waiter(self):
 		waiter = _anyio.create_event()
-		self._waiters.append(waiter)
-		gotit = False
-		try:	# restore state no matter what (e.g., KeyboardInterrupt)
+		self._waiters[waiter] = None
+		return waiter
+
+	async def _wait(self, waiter, timeout):
+		try:
 			if timeout is None:
 				await waiter.wait()
-				gotit = True
 			else:
 				async with _anyio.move_on_after(timeout):
 					await waiter.wait()
-					gotit = True
-			return gotit
-		finally:
-			if not gotit:
-				try:
-					self._waiters.remove(waiter)
-				except ValueError:
-					pass
-
-	def wait(self, timeout=None):
-		_await(self._wait(timeout))
+		except BaseException:
+			try:
+				del self._waiters[waiter]
+			except KeyError:
+				# don't lose the notification
+				self._notify(1)
+			raise
+		if waiter.is_set():
+			return True
+		try:
+			del self._waiters[waiter]
+		except KeyError:
+			return True  # notified by a native thread
+		return False
 
 	def wait_for(self, predicate, timeout=None):
 		"""Wait until a condition evaluates to True.
@@ -338,16 +633,24 @@ class Condition:
 		while not result:
 			if waittime is not None:
 				if endtime is None:
-					endtime = _time() + waittime
+					endtime = _monotonic() + waittime
 				else:
-					waittime = endtime - _time()
+					waittime = endtime - _monotonic()
 					if waittime <= 0:
 						break
 			self.wait(waittime)
 			result = predicate()
 		return result
 
-	async def _notify(self, n):
+	def _notify(self, n):
+		waiters = self._waiters
+		while n and waiters:
+			waiter = next(iter(waiters))
+			del waiters[waiter]
+			_set_event(waiter)
+			n -= 1
+
+	def notify(self, n=1):
 		"""Wake up one or more threads waiting on this condition, if any.
 
 		If the calling thread has not acquired the lock when this method is
@@ -359,19 +662,7 @@ class Condition:
 		"""
 		if not self._is_owned():
 			raise RuntimeError("cannot notify on un-acquired lock")
-		all_waiters = self._waiters
-		waiters_to_notify = _deque(_islice(all_waiters, n))
-		if not waiters_to_notify:
-			return
-		for waiter in waiters_to_notify:
-			await waiter.set()
-			try:
-				all_waiters.remove(waiter)
-			except ValueError:
-				pass
-
-	def notify(self, n=1):
-		_await(self._notify(n))
+		self._notify(n)
 
 	def notify_all(self):
 		"""Wake up all threads waiting on this condition.
@@ -380,30 +671,45 @@ class Condition:
 		is called, a RuntimeError is raised.
 
 		"""
-		self.notify(len(self._waiters))
+		if not self._is_owned():
+			raise RuntimeError("cannot notify on un-acquired lock")
+		waiters = self._waiters
+		if waiters:
+			self._waiters = {}
+			for waiter in waiters:
+				_set_event(waiter)
 
 	notifyAll = notify_all
 
 
-# This is a straight copy from `threading`.
+class _Generation:
+	__slots__ = ('evt', 'broken')
+
+	def __init__(self):
+		self.evt = None  # created by the first waiter
+		self.broken = False
 
 @_patch
 class Barrier:
-	def __init__(self, parties, action=None, timeout=None):
-		"""Create a barrier, initialised to 'parties' threads.
+	"""
+	A barrier.
 
-		'action' is a callable which, when supplied, will be called by one of
-		the threads after they have all entered the barrier and just prior to
-		releasing them all. If a 'timeout' is provided, it is used as the
-		default for all subsequent 'wait()' calls.
+	Each round ("generation") has its own event which releases all of its
+	waiters at once; arriving only increments a counter. Tasks that arrive
+	while the action runs belong to the next generation.
 
-		"""
-		self._cond = Condition(Lock())
+	Native threads wait in a task of the event loop. If one of them is
+	the last to arrive, the action runs in that task.
+	"""
+	def __init__(self, parties, action=None, timeout=None):
+		if parties < 1:
+			raise ValueError("parties must be > 0")
 		self._action = action
 		self._timeout = timeout
 		self._parties = parties
-		self._state = 0 #0 filling, 1, draining, -1 resetting, -2 broken
 		self._count = 0
+		self._broken = False
+		self._gen = _Generation()
 
 	def wait(self, timeout=None):
 		"""Wait for the barrier.
@@ -414,69 +720,62 @@ class Barrier:
 		Returns an individual index number from 0 to 'parties-1'.
 
 		"""
+		if _aevent._native_thread():
+			return _from_thread(self.wait, timeout)
 		if timeout is None:
 			timeout = self._timeout
-		with self._cond:
-			self._enter() # Block while the barrier drains.
-			index = self._count
-			self._count += 1
-			try:
-				if index + 1 == self._parties:
-					# We release the barrier
-					self._release()
-				else:
-					# We wait until someone releases us
-					self._wait(timeout)
-				return index
-			finally:
-				self._count -= 1
-				# Wake up any threads waiting for barrier to drain.
-				self._exit()
-
-	# Block until the barrier is ready for us, or raise an exception
-	# if it is broken.
-	def _enter(self):
-		while self._state in (-1, 1):
-			# It is draining or resetting, wait until done
-			self._cond.wait()
-		#see if the barrier is in a broken state
-		if self._state < 0:
+		if self._broken:
 			raise BrokenBarrierError
-		assert self._state == 0
-
-	# Optionally run the 'action' and release the threads waiting
-	# in the barrier.
-	def _release(self):
+		gen = self._gen
+		index = self._count
+		if index + 1 == self._parties:
+			self._next_gen()
+			try:
+				if self._action:
+					self._action()
+			except BaseException:
+				self._wake(gen, True)
+				self._break()
+				raise
+			self._wake(gen)
+			return index
+
+		self._count += 1
+		if gen.evt is None:
+			gen.evt = _anyio.create_event()
 		try:
-			if self._action:
-				self._action()
-			# enter draining state
-			self._state = 1
-			self._cond.notify_all()
-		except:
-			#an exception during the _action handler.  Break and reraise
-			self._break()
+			released = _await(self._wait(gen.evt, timeout))
+		except BaseException:
+			if gen is self._gen:
+				self._break()
 			raise
-
-	# Wait in the barrier until we are released.  Raise an exception
-	# if the barrier is reset or broken.
-	def _wait(self, timeout):
-		if not self._cond.wait_for(lambda : self._state != 0, timeout):
-			#timed out.  Break the barrier
+		# A native thread may have moved on to the next generation
+		# without setting our event yet.
+		if not released and gen is self._gen:
 			self._break()
 			raise BrokenBarrierError
-		if self._state < 0:
+		if gen.broken:
 			raise BrokenBarrierError
-		assert self._state == 1
+		return index
 
-	# If we are the last thread to exit the barrier, signal any threads
-	# waiting for the barrier to drain.
-	def _exit(self):
-		if self._count == 0:
-			if self._state in (-1, 1):
-				#resetting or draining
-				self._state = 0
-				self._cond.notify_all()
+	async def _wait(self, evt, timeout):
+		if timeout is None:
+			await evt.wait()
+		else:
+			async with _anyio.move_on_after(timeout):
+				await evt.wait()
+		return evt.is_set()
+
+	def _next_gen(self):
+		gen = self._gen
+		self._gen = _Generation()
+		self._count = 0
+		return gen
+
+	def _wake(self, gen, broken=False):
+		gen.broken = broken
+		if gen.evt is not None:
+			_set_event(gen.evt)
 
 	def reset(self):
 		"""Reset the barrier to the initial state.
@@ -485,18 +784,8 @@ class Barrier:
 		raised.
 
 		"""
-		with self._cond:
-			if self._count > 0:
-				if self._state == 0:
-					#reset the barrier, waking up threads
-					self._state = -1
-				elif self._state == -2:
-					#was broken, set it to reset state
-					#which clears when the last thread exits
-					self._state = -1
-			else:
-				self._state = 0
-			self._cond.notify_all()
+		self._broken = False
+		self._wake(self._next_gen(), True)
 
 	def abort(self):
 		"""Place the barrier into a 'broken' state.
@@ -505,14 +794,11 @@ class Barrier:
 		attempting to 'wait()' will have BrokenBarrierError raised.
 
 		"""
-		with self._cond:
-			self._break()
+		self._break()
 
 	def _break(self):
-		# An internal error was detected.  The barrier is set to
-		# a broken state all parties awakened.
-		self._state = -2
-		self._cond.notify_all()
+		self._broken = True
+		self._wake(self._next_gen(), True)
 
 	@property
 	def parties(self):
@@ -522,16 +808,12 @@ class Barrier:
 	@property
 	def n_waiting(self):
 		"""Return the number of threads currently waiting at the barrier."""
-		# We don't need synchronization here since this is an ephemeral result
-		# anyway.  It returns the correct value in the steady state.
-		if self._state == 0:
-			return self._count
-		return 0
+		return self._count
 
 	@property
 	def broken(self):
 		"""Return True if the barrier is in a broken state."""
-		return self._state == -2
+		return self._broken
 
 # exception raised by the Barrier class
 class BrokenBarrierError(RuntimeError):
@@ -540,35 +822,279 @@ class BrokenBarrierError(RuntimeError):
 
 @_patch
 class Event:
-	_event = None
+	"""
+	An event.
 
-	@property
-	def _evt(self):
-		if self._event is None:
-			self._event = _anyio.create_event()
-		return self._event
+	Checking, setting and waiting for an event that's already set don't
+	touch the event loop. The underlying anyio event is only created when
+	somebody needs to wait for it.
+	"""
+	def __init__(self):
+		self._flag = False
+		self._event = None
+
+	def is_set(self):
+		return self._flag
+
+	isSet = is_set
+
+	def set(self):
+		if self._flag:
+			return
+		self._flag = True
+		evt = self._event
+		if evt is not None:
+			self._event = None
+			_set_event(evt)
+
+	def clear(self):
+		self._flag = False
 
-	async def _wait(self, timeout):
+	def wait(self, timeout=None):
+		if self._flag:
+			return True
+		if timeout is not None and timeout <= 0:
+			return False
+		if _aevent._native_thread():
+			return _from_thread(self.wait, timeout)
+		evt = self._event
+		if evt is None:
+			evt = self._event = _anyio.create_event()
+			if self._flag:
+				return True  # a native thread didn't see the new event
+		return _await(self._wait(evt, timeout))
+
+	async def _wait(self, evt, timeout):
 		if timeout is None:
-			await self._evt.wait()
+			await evt.wait()
 		else:
+			async with _anyio.move_on_after(timeout):
+				await evt.wait()
+		return evt.is_set() or self._flag
+
+class _Semaphore:
+	"""
+	A semaphore.
+
+	Acquiring an available permit doesn't touch the event loop. `release`
+	hands permits directly to waiters, in FIFO order.
+	"""
+	def __init__(self, value=1):
+		if value < 0:
+			raise ValueError("semaphore initial value must be >= 0")
+		self._value = value
+		self._waiters = None  # deque of events, created on contention
+
+	def __repr__(self):
+		return "<%s object value=%d at %#x>" % (type(self).__name__, self._value, id(self))
+
+	def acquire(self, blocking=True, timeout=None):
+		if not blocking and timeout is not None:
+			raise ValueError("can't specify timeout for non-blocking acquire")
+		if self._value:
+			self._value -= 1
+			return True
+		if not blocking:
+			return False
+		return _await(self._acquire_wait(timeout))
+
+	async def _acquire_wait(self, timeout):
+		if self._waiters is None:
+			self._waiters = _deque()
+		evt = _anyio.create_event()
+		self._waiters.append(evt)
+		if self._value:
+			# released by a native thread before we were queued
+			self._value -= 1
 			try:
-				async with _anyio.fail_after(timeout):
-					await self._evt.wait()
-			except TimeoutError:
-				return False
-		return True
+				self._waiters.remove(evt)
+			except ValueError:
+				# another release handed us a second permit
+				self.release()
+			return True
+		try:
+			if timeout is None:
+				await evt.wait()
+			else:
+				async with _anyio.move_on_after(timeout):
+					await evt.wait()
+		except BaseException:
+			try:
+				self._waiters.remove(evt)
+			except ValueError:
+				# We got a permit but can't use it.
+				self.release()
+			raise
+		if evt.is_set():
+			return True
+		try:
+			self._waiters.remove(evt)
+		except ValueError:
+			return True  # woken by a native thread
+		return False
+
+	def release(self, n=1):
+		if n < 1:
+			raise ValueError('n must be one or more')
+		waiters = self._waiters
+		while n and waiters:
+			_set_event(waiters.popleft())
+			n -= 1
+		self._value += n
 
-	def wait(self, timeout=None):
-		return _await(self._wait(timeout))
+	def __enter__(self):
+		return self.acquire()
+	def __exit__(self, *tb):
+		self.release()
+	async def __aenter__(self):
+		if self._value:
+			self._value -= 1
+		else:
+			await self._acquire_wait(None)
+	async def __aexit__(self, *tb):
+		self.release()
 
-	def set(self):
-		_await(self._evt.set())
 
-	def clear(self):
-		self._event = _anyio.create_event()
-	
-	def is_set(self):
-		return self._evt.is_set()
+@_patch
+class Semaphore(_Semaphore):
+	pass
+
+
+@_patch
+class BoundedSemaphore(_Semaphore):
+	def __init__(self, value=1):
+		super().__init__(value)
+		self._initial_value = value
+
+	def release(self, n=1):
+		if self._value + n > self._initial_value:
+			raise ValueError("Semaphore released too many times")
+		super().release(n)
+
+
+class _TimerQueue:
+	"""
+	Runs the timers of one task group from a single task.
+
+	Timers sit in a heap sorted by deadline. Cancelled timers stay in
+	the heap and are skipped; when no live timer is left the heap is
+	dropped and the task ends.
+
+	Daemon timers have a queue of their own. Like a daemon thread's,
+	its task is cancelled when the runner exits; timers that are still
+	pending then never fire.
+	"""
+	def __init__(self, tg, daemon):
+		self.tg = tg
+		self.daemon = daemon
+		self.ctx = None
+		self.heap = []
+		self.live = 0
+		self.seq = 0
+		self.running = False
+		self.wakeup = None
+
+	def add(self, timer):
+		self.seq += 1
+		self.live += 1
+		_heappush(self.heap, (timer._deadline, self.seq, timer))
+		if self.heap[0][2] is timer:
+			self.wake()
+		if not self.running:
+			self.running = True
+			if self.daemon:
+				self.ctx = _Daemon(_daemons[self.tg])
+			_run_nowait(_aevent._spawn(self.tg, self._run, name="timers"))
+
+	def cancelled(self):
+		self.live -= 1
+		if not self.live:
+			self.heap.clear()
+			self.wake()
+
+	def wake(self):
+		evt = self.wakeup
+		if evt is not None:
+			self.wakeup = None
+			_set_event(evt)
+
+	async def _run(self):
+		heap = self.heap
+		try:
+			if self.ctx is not None:
+				await self.ctx.run(self._fire)
+			else:
+				await self._fire()
+		finally:
+			self.ctx = None
+			self.running = False
+			self.wakeup = None
+			# only left over if we've been cancelled
+			while heap:
+				timer = _heappop(heap)[2]
+				if timer._state == 0:
+					timer._state = 2
+					timer._finish()
+			self.live = 0
+
+	async def _fire(self):
+		heap = self.heap
+		while heap:
+			deadline, _, timer = heap[0]
+			delay = deadline - _monotonic()
+			if delay <= 0:
+				_heappop(heap)
+				if timer._state == 0:
+					timer._state = 1
+					self.live -= 1
+					await _aevent._spawn(self.tg, timer._bootstrap, name=timer.name)
+				continue
+			self.wakeup = evt = _anyio.create_event()
+			async with _anyio.move_on_after(delay):
+				await evt.wait()
+
+_timer_queues = [None, None]  # indexed by the daemon flag
+
+@_patch
+class Timer(_Thread):
+	"""
+	Call a function after a specified number of seconds.
+
+	Timers don't get a task of their own until they fire: a single task
+	per task group waits for the next deadline.
+	"""
+	_state = None  # None: not started, 0: pending, 1: fired, 2: cancelled
+
+	def __init__(self, interval, function, args=None, kwargs=None):
+		super().__init__()
+		self.interval = interval
+		self.function = function
+		self.args = args if args is not None else []
+		self.kwargs = kwargs if kwargs is not None else {}
+		self.finished = Event()
+
+	def start(self):
+		tg = self._prepare()
+		daemon = bool(self._daemon)
+		q = _timer_queues[daemon]
+		if q is None or q.tg is not tg:
+			q = _timer_queues[daemon] = _TimerQueue(tg, daemon)
+		self._queue = q
+		self._deadline = _monotonic() + self.interval
+		self._state = 0
+		q.add(self)
+
+	def cancel(self):
+		"""Stop the timer if it hasn't finished yet."""
+		self.finished.set()
+		if self._state == 0:
+			self._state = 2
+			self._queue.cancelled()
+			self._finish()
+
+	def run(self):
+		if not self.finished.is_set():
+			self.function(*self.args, **self.kwargs)
+		self.finished.set()
 
 # _shutdown is not patched
@@ -0,0 +1,205 @@
+"""
+Time slices for sync code.
+
+Sync code only yields to the event loop when it calls something that
+blocks, so a long CPU-bound loop starves all other tasks. When time
+slicing is on, a CPU timer sends SIGVTALRM to the process while it's
+busy. If the current task has run for longer than its slice, the signal
+handler yields to the event loop via the task's greenback portal.
+
+This can't be done with a trace function: the interpreter switches
+tracing off while one runs, so yielding from it would stop tracing for
+all other tasks until the yielding task resumed.
+
+Time slicing is only done in tasks that have a portal, and only when
+the whole interrupted stack is sync code, as it is in threads and in
+functions run by `greenback.with_portal_run_sync`. Async code expects
+to keep running until it awaits something, so a coroutine anywhere on
+the stack prevents time slicing, as does the event loop, anyio,
+greenback, aevent itself or the import system being the interrupted
+code or its caller. Sync code, however, may now be interrupted
+anywhere, just as with real threads.
+
+The kernel only checks CPU timers once per clock tick, so the slices
+are not more precise than that. A task is interrupted after at most
+one and a half slices, plus one tick.
+
+The time each task spends running is recorded while time slicing is
+on. On trio this uses an instrument; on asyncio, the loop's
+`Handle._run` method is wrapped.
+"""
+
+import signal
+from inspect import CO_COROUTINE, CO_ITERABLE_COROUTINE, CO_ASYNC_GENERATOR
+from time import perf_counter as _clock
+from weakref import WeakKeyDictionary
+
+import greenback
+
+import aevent as _aevent
+
+__all__ = ["start", "stop", "attach", "task_time"]
+
+# Don't interrupt code from these packages.
+_no_slice = frozenset(('trio', 'anyio', 'asyncio', 'sniffio', 'outcome',
+                       'greenback', 'greenlet', 'aevent', 'contextlib',
+                       'importlib', '_frozen_importlib'))
+_CO_ASYNC = CO_COROUTINE | CO_ITERABLE_COROUTINE | CO_ASYNC_GENERATOR
+
+_slice = None  # seconds, or None if we're not active
+_deadline = 0.0  # when the current task should yield
+_prev_handler = None
+_backend = None
+_task_time = WeakKeyDictionary()  # task > seconds
+_run_var = None  # trio: marks runs with our instrument
+_instrument = None  # trio: the instrument class
+_handle_run = None  # asyncio: the original Handle._run
+_Task = None  # asyncio.Task
+
+
+def start(backend, ms):
+    """
+    Start time slicing with slices of `ms` milliseconds.
+    """
+    global _slice, _backend, _handle_run, _run_var, _Task, _prev_handler
+    if ms <= 0:
+        raise ValueError("The time slice must be positive, not %r" % (ms,))
+    if _slice is None:
+        _prev_handler = signal.signal(signal.SIGVTALRM, _handler)
+    _slice = ms / 1000
+    _backend = backend
+    if backend == 'trio':
+        import trio
+        if _run_var is None:
+            _run_var = trio.lowlevel.RunVar('aevent_timeslice', default=False)
+    elif _handle_run is None:
+        from asyncio import Task as _Task
+        from asyncio.events import Handle
+        _handle_run = Handle._run
+        Handle._run = _run_handle
+    # Check twice per slice.
+    signal.setitimer(signal.ITIMER_VIRTUAL, _slice / 2, _slice / 2)
+
+
+def stop():
+    """
+    Stop time slicing.
+    """
+    global _slice, _handle_run
+    if _slice is None:
+        return
+    _slice = None
+    signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+    signal.signal(signal.SIGVTALRM, _prev_handler or signal.SIG_DFL)
+    if _handle_run is not None:
+        from asyncio.events import Handle
+        Handle._run = _handle_run
+        _handle_run = None
+
+
+def attach():
+    """
+    Set up accounting for the current trio run. Called by `aevent.per_task`.
+    """
+    global _instrument
+    if _slice is None or _backend != 'trio' or _run_var.get():
+        return
+    if _instrument is None:
+        _instrument = _make_instrument()
+    import trio
+    trio.lowlevel.add_instrument(_instrument())
+    _run_var.set(True)
+
+
+def task_time(task=None):
+    """
+    Return the time the task `task` (default: the current one) has spent
+    running, in seconds.
+
+    Time is only recorded while time slicing is on.
+    """
+    if task is None:
+        from aevent.local import _owner
+        task = _owner()
+    try:
+        return _task_time.get(task, 0.0)
+    except TypeError:
+        return 0.0  # not a task
+
+
+def _handler(sig, frame):
+    # Runs in the main thread, between two bytecodes of `frame`.
+    if _slice is None or _clock() < _deadline:
+        return
+    if frame is None or frame.f_globals.get('__name__', '').partition('.')[0] in _no_slice:
+        return
+    back = frame.f_back
+    if back is not None and back.f_globals.get('__name__', '').partition('.')[0] in _no_slice:
+        return
+    while frame is not None:
+        if frame.f_code.co_flags & _CO_ASYNC:
+            return
+        frame = frame.f_back
+    if _aevent._no_patch_used and _aevent.no_patch.get():
+        return
+    try:
+        if not greenback.has_portal():
+            return
+    except RuntimeError:
+        return  # not in a task
+    greenback.await_(_checkpoint())
+
+
+async def _checkpoint():
+    # Let other tasks run. Cancellation is delivered at the task's next
+    # real checkpoint, not here.
+    if _backend == 'trio':
+        import trio
+        await trio.lowlevel.cancel_shielded_checkpoint()
+    else:
+        import anyio
+        async with anyio.open_cancel_scope(shield=True):
+            await anyio.sleep(0)
+
+
+def _account(task, start):
+    try:
+        _task_time[task] = _task_time.get(task, 0.0) + _clock() - start
+    except TypeError:
+        pass
+
+
+def _run_handle(self):
+    # asyncio: every task step is a callback run by a Handle.
+    global _deadline
+    start = _clock()
+    _deadline = start + _slice
+    try:
+        _handle_run(self)
+    finally:
+        task = getattr(self._callback, '__self__', None)
+        if isinstance(task, _Task):
+            _account(task, start)
+
+
+def _make_instrument():
+    import trio
+
+    class _TrioInstrument(trio.abc.Instrument):
+        """
+        Record the time each task runs, and start its time slice.
+        """
+        def __init__(self):
+            self.start = _clock()  # we may be added during a step
+
+        def before_task_step(self, task):
+            global _deadline
+            if _slice is not None:
+                self.start = _clock()
+                _deadline = self.start + _slice
+
+        def after_task_step(self, task):
+            if _slice is not None:
+                _account(task, self.start)
+
+    return _TrioInstrument
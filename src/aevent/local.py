@@ -1,116 +1,166 @@
 """
-Copied from Python's _threading_local.py
+Task-local data.
+
+Each task's attribute dict is stored in a ContextVar that belongs to the
+`local` object. A task inherits its parent's context, so the entry also
+remembers which task created the dict; a task that finds somebody else's
+entry starts a fresh one. The dict is only referenced from the task's
+context, so it goes away as soon as the task ends.
+
+Tasks run one at a time and attribute access doesn't yield to the event
+loop, so no lock is required. The dict is never stored in the object
+itself: attribute access looks it up and then follows the usual rules,
+i.e. the class's data descriptors come first, then the dict, then other
+class attributes. Whether a class has a data descriptor of some name is
+remembered, so that the common case is a plain dict lookup. Native
+threads have their own contexts, so they can use the object at the same
+time without seeing each other's data.
 """
 
+from contextvars import ContextVar
 from weakref import ref
-from contextlib import contextmanager
 
 __all__ = ["local"]
 
-# We need to use objects from the threading module, but the threading
-# module may also want to use our `local` class, if support for locals
-# isn't compiled in to the `thread` module.  This creates potential problems
-# with circular imports.  For that reason, we don't import `threading`
-# until the bottom of this file (a hack sufficient to worm around the
-# potential problems).  Note that all platforms on CPython do have support
-# for locals in the `thread` module, and there is no circular import problem
-# then, so problems introduced by fiddling the order of imports here won't
-# manifest.
-
-class _localimpl:
-    """A class managing thread-local dicts"""
-    __slots__ = 'key', 'dicts', 'localargs', 'locallock', '__weakref__'
-
-    def __init__(self):
-        # The key used in the Thread objects' attribute dicts.
-        # We keep it a string for speed but make it unlikely to clash with
-        # a "real" attribute.
-        self.key = '_threading_local._localimpl.' + str(id(self))
-        # { id(Thread) -> (ref(Thread), thread-local dict) }
-        self.dicts = {}
-
-    def get_dict(self):
-        """Return the dict for the current thread. Raises KeyError if none
-        defined."""
-        thread = current_thread()
-        return self.dicts[id(thread)][1]
-
-    def create_dict(self):
-        """Create a new dict for the current thread, and return it."""
-        localdict = {}
-        key = self.key
-        thread = current_thread()
-        idt = id(thread)
-        def local_deleted(_, key=key):
-            # When the localimpl is deleted, remove the thread attribute.
-            thread = wrthread()
-            if thread is not None:
-                del thread.__dict__[key]
-        def thread_deleted(_, idt=idt):
-            # When the thread is deleted, remove the local dict.
-            # Note that this is suboptimal if the thread object gets
-            # caught in a reference loop. We would like to be called
-            # as soon as the OS-level thread ends instead.
-            local = wrlocal()
-            if local is not None:
-                dct = local.dicts.pop(idt)
-        wrlocal = ref(self, local_deleted)
-        wrthread = ref(thread, thread_deleted)
-        thread.__dict__[key] = wrlocal
-        self.dicts[idt] = wrthread, localdict
-        return localdict
-
-
-@contextmanager
-def _patch(self):
-    impl = object.__getattribute__(self, '_local__impl')
+
+class _Root:
+    """The owner of data that's used outside of any task."""
+
+_root = _Root()
+
+def _current_task():
+    # replaced by the backend's version once that is known
+    global _current_task
+    import aevent
+    if aevent._backend == "trio":
+        from trio.lowlevel import current_task as _current_task
+    elif aevent._backend == "asyncio":
+        from asyncio import current_task as _current_task
+    else:
+        return None  # not set up yet
+    return _current_task()
+
+def _owner():
     try:
-        dct = impl.get_dict()
-    except KeyError:
-        dct = impl.create_dict()
-        args, kw = impl.localargs
-        self.__init__(*args, **kw)
-    with impl.locallock:
-        object.__setattr__(self, '__dict__', dct)
-        yield
+        return _current_task() or _root
+    except RuntimeError:
+        return _root  # not running in a task
+
+
+def _get_dict(self):
+    var = object.__getattribute__(self, '_local__var')
+    try:
+        me = _current_task() or _root  # _owner(), inlined
+    except RuntimeError:
+        me = _root
+    entry = var.get(None)
+    if entry is not None and entry[0]() is me:
+        return entry[1]
+    dct = {}
+    var.set((ref(me), dct))
+    args, kw = object.__getattribute__(self, '_local__args')
+    self.__init__(*args, **kw)
+    return dct
+
+
+_missing = object()
+
+def _class_attr(cls, name):
+    for base in cls.__mro__:
+        attr = base.__dict__.get(name, _missing)
+        if attr is not _missing:
+            return attr
+    return _missing
+
+def _is_data_descr(attr):
+    return hasattr(type(attr), '__set__') or hasattr(type(attr), '__delete__')
+
+_data_descr = {}  # (class, name) > whether that's a data descriptor
+
+def _has_data_descr(cls, name):
+    # the cache miss of `_data_descr[cls, name]`
+    res = _data_descr[cls, name] = _is_data_descr(_class_attr(cls, name))
+    return res
 
 
 class local:
-    __slots__ = '_local__impl', '__dict__'
+    __slots__ = '_local__var', '_local__args'
 
     def __new__(cls, *args, **kw):
         if (args or kw) and (cls.__init__ is object.__init__):
             raise TypeError("Initialization arguments are not supported")
         self = object.__new__(cls)
-        impl = _localimpl()
-        impl.localargs = (args, kw)
-        impl.locallock = RLock()
-        object.__setattr__(self, '_local__impl', impl)
-        # We need to create the thread dict in anticipation of
-        # __init__ being called, to make sure we don't call it
-        # again ourselves.
-        impl.create_dict()
+        object.__setattr__(self, '_local__args', (args, kw))
+        var = ContextVar('local_%x' % id(self))
+        object.__setattr__(self, '_local__var', var)
+        # The current task's dict is the one that __init__ is about to
+        # fill in.
+        var.set((ref(_owner()), {}))
         return self
 
     def __getattribute__(self, name):
-        with _patch(self):
-            return object.__getattribute__(self, name)
+        dct = _get_dict(self)
+        if name == '__dict__':
+            return dct
+        cls = type(self)
+        try:
+            data = _data_descr[cls, name]
+        except KeyError:
+            data = _has_data_descr(cls, name)
+        if not data:
+            if name in dct:
+                return dct[name]
+            attr = _class_attr(cls, name)
+        else:
+            attr = _class_attr(cls, name)
+            get = getattr(type(attr), '__get__', None)
+            if get is not None:
+                return get(attr, self, cls)
+            if name in dct:
+                return dct[name]
+        if attr is _missing:
+            raise AttributeError("%r object has no attribute %r"
+                                 % (cls.__name__, name))
+        get = getattr(type(attr), '__get__', None)
+        if get is None:
+            return attr
+        return get(attr, self, cls)
 
     def __setattr__(self, name, value):
         if name == '__dict__':
             raise AttributeError(
                 "%r object attribute '__dict__' is read-only"
                 % self.__class__.__name__)
-        with _patch(self):
-            return object.__setattr__(self, name, value)
+        dct = _get_dict(self)
+        cls = type(self)
+        try:
+            data = _data_descr[cls, name]
+        except KeyError:
+            data = _has_data_descr(cls, name)
+        if data:
+            attr = _class_attr(cls, name)
+            if hasattr(type(attr), '__set__'):
+                type(attr).__set__(attr, self, value)
+                return
+        dct[name] = value
 
     def __delattr__(self, name):
         if name == '__dict__':
             raise AttributeError(
                 "%r object attribute '__dict__' is read-only"
                 % self.__class__.__name__)
-        with _patch(self):
-            return object.__delattr__(self, name)
-
-
-from threading import current_thread, RLock
+        dct = _get_dict(self)
+        cls = type(self)
+        try:
+            data = _data_descr[cls, name]
+        except KeyError:
+            data = _has_data_descr(cls, name)
+        if data:
+            attr = _class_attr(cls, name)
+            if hasattr(type(attr), '__delete__'):
+                type(attr).__delete__(attr, self)
+                return
+        try:
+            del dct[name]
+        except KeyError:
+            raise AttributeError(name) from None
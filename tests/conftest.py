@@ -4,8 +4,22 @@ backend = os.environ.get("AEVENT_BACKEND","trio")
 aevent.setup(backend)
 
 import pytest
+from functools import wraps
+from inspect import iscoroutinefunction
 
 @pytest.fixture
 def anyio_backend():
     return backend
 
+@pytest.hookimpl(hookwrapper=True)
+def pytest_pyfunc_call(pyfuncitem):
+    # aevent's trio test runner sets up each test's task via `per_task`.
+    # On asyncio, the tests do that themselves.
+    fn = pyfuncitem.obj
+    if backend != "trio" and iscoroutinefunction(fn):
+        @wraps(fn)
+        async def with_portal(**kw):
+            await aevent.per_task()
+            return await fn(**kw)
+        pyfuncitem.obj = with_portal
+    yield
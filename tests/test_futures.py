@@ -0,0 +1,59 @@
+#
+# Test the patched concurrent.futures.
+#
+
+import pytest
+
+import concurrent.futures as cf
+import threading
+import time
+import anyio
+import aevent
+
+running = 0
+max_running = 0
+
+def work(n):
+    global running, max_running
+    running += 1
+    max_running = max(running, max_running)
+    time.sleep(0.02)
+    running -= 1
+    if n == 3:
+        raise ValueError(n)
+    return n * 2
+
+@pytest.mark.anyio
+async def test_executor():
+    """Work items run as tasks, limited by max_workers."""
+    async with aevent.runner():
+        t1 = time.time()
+        with cf.ThreadPoolExecutor(max_workers=3) as ex:
+            fs = [ex.submit(work, n) for n in range(6)]
+            assert fs[0].result() == 0
+            with pytest.raises(ValueError):
+                fs[3].result()
+            assert await fs[5] == 10
+        assert 0.03 < time.time() - t1 < 0.5
+        assert max_running == 3
+
+        with cf.ThreadPoolExecutor(max_workers=2) as ex:
+            assert list(ex.map(work, [0, 1, 2])) == [0, 2, 4]
+            fs = [ex.submit(work, n) for n in (1, 2, 3)]
+            done, not_done = cf.wait(fs, return_when=cf.FIRST_EXCEPTION)
+            assert fs[2] in done
+            assert sorted(f.result() for f in cf.as_completed(fs[:2])) == [2, 4]
+            with pytest.raises(cf.TimeoutError):
+                ex.submit(time.sleep, 0.1).result(timeout=0.01)
+            ex.shutdown(cancel_futures=True)
+
+def native():
+    return threading.current_thread() is threading.main_thread()
+
+@pytest.mark.anyio
+async def test_offload():
+    """offload=True uses real threads."""
+    async with aevent.runner():
+        with cf.ThreadPoolExecutor(offload=True) as ex:
+            f = ex.submit(native)
+            assert f.result() is False
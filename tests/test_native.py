@@ -0,0 +1,218 @@
+#
+# Test using patched code from native threads.
+#
+
+import pytest
+
+import _thread
+import queue
+import socket
+import threading
+import time
+import anyio
+
+def native(q, r, res):
+    res.append(type(threading.Lock()).__module__)
+    time.sleep(0.01)
+    for n in range(5):
+        q.put(n)  # waits while the queue is full
+    res.append(r.get())
+
+async def consume(q, r, res):
+    for n in range(5):
+        res.append(q.get())
+    r.put("done")
+
+@pytest.mark.anyio
+async def test_queue():
+    """A queue connects tasks and native threads."""
+    q = queue.Queue(2)
+    r = queue.Queue()
+    res = []
+    _thread.start_new_thread(native, (q, r, res))
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(consume, q, r, res)
+    while len(res) < 7:
+        await anyio.sleep(0.01)
+    assert res == ["_thread", 0, 1, 2, 3, 4, "done"]
+
+def native_io(evt, sock, res):
+    evt.wait()
+    sock.settimeout(1)
+    res.append(sock.recv(10))
+    res.append(threading.get_ident() == _thread.get_ident())
+    evt.clear()
+
+@pytest.mark.anyio
+async def test_event_socket():
+    """Events and sockets work natively."""
+    evt = threading.Event()
+    a, b = socket.socketpair()
+    res = []
+    _thread.start_new_thread(native_io, (evt, b, res))
+    await anyio.sleep(0.05)
+    evt.set()
+    await anyio.sleep(0.05)
+    a.send(b"hello")
+    while evt.is_set():
+        await anyio.sleep(0.01)
+    assert res == [b"hello", True]
+    a.close()
+    b.close()
+
+def in_thread(fn, *args):
+    # run fn in a native thread, return a list that collects its result
+    res = []
+    def run():
+        try:
+            res.append(fn(*args))
+        except BaseException as exc:
+            res.append(exc)
+    _thread.start_new_thread(run, ())
+    return res
+
+async def collect(*results):
+    while not all(results):
+        await anyio.sleep(0.01)
+    return [r[0] for r in results]
+
+def locked_work(lock, state):
+    for _ in range(10):
+        with lock:
+            with lock:
+                assert not state["busy"]
+                state["busy"] = True
+                time.sleep(0.001)
+                state["busy"] = False
+                state["n"] += 1
+
+@pytest.mark.anyio
+async def test_rlock():
+    """An RLock excludes native threads from each other, and from tasks."""
+    lock = threading.RLock()
+    state = dict(busy=False, n=0)
+    r1 = in_thread(locked_work, lock, state)
+    r2 = in_thread(locked_work, lock, state)
+    locked_work(lock, state)
+    assert await collect(r1, r2) == [None, None]
+    assert state["n"] == 30
+    assert not lock._is_owned()
+
+def wait_for_go(cond, state):
+    with cond:
+        assert cond.wait_for(lambda: state["go"], 5)
+        state["go"] = False
+        cond.notify()
+    return "ok"
+
+@pytest.mark.anyio
+async def test_condition():
+    """Native threads and tasks wait for each other on a condition."""
+    cond = threading.Condition()
+    state = dict(go=False)
+    res = in_thread(wait_for_go, cond, state)
+    time.sleep(0.05)
+    with cond:
+        state["go"] = True
+        cond.notify()
+        assert cond.wait_for(lambda: not state["go"], 5)
+    assert await collect(res) == ["ok"]
+
+@pytest.mark.anyio
+async def test_barrier():
+    """Native threads and a task meet at a barrier."""
+    barrier = threading.Barrier(3)
+    r1 = in_thread(barrier.wait, 5)
+    r2 = in_thread(barrier.wait, 5)
+    idx = barrier.wait(5)
+    assert sorted(await collect(r1, r2) + [idx]) == [0, 1, 2]
+
+def local_worker(loc, n):
+    for _ in range(20000):
+        loc.n = n
+        if loc.n != n:
+            return loc.n
+    return n
+
+@pytest.mark.anyio
+async def test_local():
+    """Native threads using the same task-local object don't interfere."""
+    loc = threading.local()
+    loc.n = "task"
+    r1 = in_thread(local_worker, loc, 1)
+    r2 = in_thread(local_worker, loc, 2)
+    assert await collect(r1, r2) == [1, 2]
+    assert loc.n == "task"
+
+def release_while_queueing(monkeypatch, hold, release):
+    # In a native thread, call hold(), then call release() exactly between
+    # the point where a task decides to wait and the point where it is
+    # queued as a waiter.
+    held = _thread.allocate_lock()
+    held.acquire()
+    go = _thread.allocate_lock()
+    go.acquire()
+    done = _thread.allocate_lock()
+    done.acquire()
+    create_event = anyio.create_event
+
+    def delayed_create_event():
+        monkeypatch.setattr(anyio, "create_event", create_event)
+        go.release()
+        done.acquire()
+        return create_event()
+
+    def run():
+        hold()
+        held.release()
+        go.acquire()
+        release()
+        done.release()
+
+    _thread.start_new_thread(run, ())
+    held.acquire()
+    monkeypatch.setattr(anyio, "create_event", delayed_create_event)
+
+@pytest.mark.anyio
+async def test_wakeup_race(monkeypatch):
+    """A native thread's put or release isn't lost while a task starts to wait."""
+    q = queue.Queue()
+    release_while_queueing(monkeypatch, lambda: None, lambda: q.put("hello"))
+    t = time.monotonic()
+    assert q.get(timeout=2) == "hello"
+    assert time.monotonic() - t < 1
+
+    for lock in (threading.Lock(), threading.RLock(), threading.Semaphore(1)):
+        release_while_queueing(monkeypatch, lock.acquire, lock.release)
+        t = time.monotonic()
+        assert lock.acquire(timeout=2)
+        assert time.monotonic() - t < 1
+        lock.release()
+
+class NamedThread(threading.Thread):
+    def __init__(self, log):
+        super().__init__(name="named")
+        self.log = log
+
+    def run(self):
+        self.log.append(threading.current_thread().name)
+
+def start_named(log):
+    thread = NamedThread(log)
+    thread.start()
+    thread.join()
+    return thread.is_alive()
+
+@pytest.mark.anyio
+async def test_thread_subclass():
+    """Subclassed threads started natively run in a real thread."""
+    import aevent
+    log = []
+    assert await collect(in_thread(start_named, log)) == [False]
+    assert await aevent.to_thread(start_named, log) is False
+
+    # joined by a task
+    thread = await aevent.to_thread(NamedThread, log)
+    await aevent.to_thread(thread.start)
+    thread.join()
+    assert log == ["named"] * 3
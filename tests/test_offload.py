@@ -0,0 +1,89 @@
+#
+# Test running sync code in native threads.
+#
+
+import pytest
+
+import _thread
+import time
+import anyio
+import aevent
+from contextvars import ContextVar
+
+var = ContextVar('var', default=None)
+
+def info():
+    return _thread.get_ident(), var.get(), aevent.no_patch.get()
+
+@aevent.offload
+def slow(t):
+    time.sleep(t)  # not patched in the worker thread
+    return t
+
+async def caller(res):
+    res.append(slow(0.1))
+
+def wait_for_cancel(res):
+    end = time.monotonic() + 1
+    while time.monotonic() < end:
+        if aevent.offload_cancelled():
+            res.append("cancelled")
+            return
+        time.sleep(0.005)
+
+@pytest.mark.anyio
+async def test_to_thread(monkeypatch):
+    """to_thread: native thread, context, no patches."""
+    # the worker thread doesn't make patched code check `no_patch`
+    monkeypatch.setattr(aevent, "_no_patch_used", False)
+    var.set("here")
+    ident, val, no_patch = await aevent.to_thread(info)
+    assert ident != _thread.get_ident()
+    assert val == "here"
+    assert no_patch
+    assert not aevent.no_patch.get()
+    assert not aevent._no_patch_used
+
+    with pytest.raises(ZeroDivisionError):
+        await aevent.to_thread(lambda: 1 / 0)
+
+@pytest.mark.anyio
+async def test_offload():
+    """offload: calls run in parallel, the loop keeps running."""
+    res = []
+    ticks = 0
+    t1 = time.monotonic()
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(caller, res)
+        await tg.spawn(caller, res)
+        while len(res) < 2:
+            ticks += 1
+            await anyio.sleep(0.01)
+    assert res == [0.1, 0.1]
+    assert time.monotonic() - t1 < 0.19
+    assert ticks > 3
+
+@aevent.offload
+def where():
+    return _thread.get_ident()
+
+@pytest.mark.anyio
+async def test_offload_native():
+    """A native thread calls an offloaded function directly."""
+    res = []
+    _thread.start_new_thread(lambda: res.append((where(), _thread.get_ident())), ())
+    while not res:
+        await anyio.sleep(0.01)
+    ident, caller = res[0]
+    assert ident == caller
+
+@pytest.mark.anyio
+async def test_offload_cancel():
+    """Cancelling the caller tells the thread."""
+    res = []
+    t1 = time.monotonic()
+    async with anyio.move_on_after(0.05):
+        await aevent.to_thread(wait_for_cancel, res)
+    assert time.monotonic() - t1 < 0.2
+    await anyio.sleep(0.05)
+    assert res == ["cancelled"]
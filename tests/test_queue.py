@@ -0,0 +1,101 @@
+#
+# Test the patched queue.
+#
+
+import pytest
+
+import queue
+import time
+import anyio
+
+async def consumer(q, log):
+    while True:
+        item = q.get()
+        if hasattr(q, "task_done"):
+            q.task_done()
+        if item is None:
+            break
+        log.append(item)
+
+async def producer(q, items):
+    for item in items:
+        q.put(item)
+
+@pytest.mark.anyio
+async def test_nowait():
+    """Non-blocking calls don't wait."""
+    q = queue.Queue(2)
+    t1 = time.time()
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+    with pytest.raises(queue.Empty):
+        q.get(block=False)
+    q.put_nowait(1)
+    q.put(2, block=False)
+    with pytest.raises(queue.Full):
+        q.put_nowait(3)
+    assert time.time() - t1 < 0.05
+    assert q.full()
+    assert q.get_nowait() == 1
+    assert q.get_nowait() == 2
+    assert q.empty()
+
+    t1 = time.time()
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.1)
+    assert 0.09 < time.time() - t1 < 1
+
+@pytest.mark.anyio
+async def test_queue():
+    """Blocking get and put, and join."""
+    q = queue.Queue(3)
+    log = []
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(consumer, q, log)
+        await tg.spawn(producer, q, list(range(10)) + [None])
+        await anyio.sleep(0.01)
+        q.join()
+    assert log == list(range(10))
+    assert q.unfinished_tasks == 0
+
+async def batch_producer(q, items):
+    q.put_many(items)
+
+@pytest.mark.anyio
+async def test_batch():
+    """get_many and put_many."""
+    q = queue.Queue(5)
+    res = []
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(batch_producer, q, range(20))
+        while len(res) < 20:
+            items = q.get_many(4)
+            assert 0 < len(items) <= 4
+            res.extend(items)
+    assert res == list(range(20))
+    with pytest.raises(queue.Empty):
+        q.get_many(4, block=False)
+
+@pytest.mark.anyio
+async def test_variants():
+    """LifoQueue, PriorityQueue and SimpleQueue."""
+    q = queue.LifoQueue()
+    q.put_many([1, 2, 3])
+    assert q.get_many(10) == [3, 2, 1]
+
+    q = queue.PriorityQueue()
+    q.put_many([5, 1, 4, 2, 3])
+    assert [q.get() for _ in range(5)] == [1, 2, 3, 4, 5]
+
+    q = queue.SimpleQueue()
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+    log = []
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(consumer, q, log)
+        await anyio.sleep(0.01)
+        for n in range(3):
+            q.put(n)
+        q.put(None)
+    assert log == [0, 1, 2]
+    assert q.empty()
@@ -0,0 +1,96 @@
+#
+# Test the patched select module.
+#
+
+import pytest
+
+import select
+import socket
+import time
+import anyio
+
+from test_socket import socketpair
+
+async def sender(sock, t):
+    time.sleep(t)
+    sock.send(b"x")
+
+@pytest.mark.anyio
+async def test_poll():
+    """poll() waits cooperatively and reports the actual events."""
+    a, b = socketpair()
+    try:
+        p = select.poll()
+        p.register(b, select.POLLIN)
+        assert p.poll(0) == []
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(sender, a, 0.1)
+            assert p.poll() == [(b.fileno(), select.POLLIN)]
+        p.modify(b, select.POLLIN | select.POLLOUT)
+        assert p.poll(100) == [(b.fileno(), select.POLLIN | select.POLLOUT)]
+        p.unregister(b)
+        assert p.poll(10) == []
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_poll_timeout():
+    """poll() times out, in milliseconds."""
+    a, b = socketpair()
+    try:
+        p = select.poll()
+        p.register(b, select.POLLIN)
+        t1 = time.time()
+        assert p.poll(200) == []
+        assert 0.19 < time.time() - t1 < 1
+        p.register(-1)
+        assert p.poll(1000) == [(-1, select.POLLNVAL)]
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_poll_file(tmp_path):
+    """poll() reports regular files as ready, like the stdlib version."""
+    with open(tmp_path / "data", "w+b") as f:
+        p = select.poll()
+        p.register(f, select.POLLIN)
+        assert p.poll() == [(f.fileno(), select.POLLIN)]
+        p.modify(f, select.POLLIN | select.POLLOUT)
+        assert p.poll(1000) == [(f.fileno(), select.POLLIN | select.POLLOUT)]
+        p.unregister(f)
+        assert p.poll(10) == []
+
+@pytest.mark.anyio
+async def test_epoll():
+    """epoll.poll() waits cooperatively."""
+    a, b = socketpair()
+    try:
+        with select.epoll() as ep:
+            ep.register(b.fileno(), select.EPOLLIN)
+            assert ep.poll(0) == []
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(sender, a, 0.1)
+                assert ep.poll() == [(b.fileno(), select.EPOLLIN)]
+        assert ep.closed
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_select():
+    """select() waits cooperatively and returns the objects passed in."""
+    a, b = socketpair()
+    try:
+        assert select.select([b], [], [], 0) == ([], [], [])
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(sender, a, 0.1)
+            assert select.select([a, b], [], []) == ([b], [], [])
+        assert select.select([b], [b.fileno()], [], 1) == ([b], [b.fileno()], [])
+        t1 = time.time()
+        assert select.select([a], [], [], 0.2) == ([], [], [])
+        assert 0.19 < time.time() - t1 < 1
+    finally:
+        a.close()
+        b.close()
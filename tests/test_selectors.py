@@ -0,0 +1,40 @@
+#
+# Test the patched selectors module.
+#
+
+import pytest
+
+import selectors
+import time
+import anyio
+
+from test_socket import socketpair
+from test_select import sender
+
+@pytest.mark.anyio
+async def test_selector():
+    """DefaultSelector waits cooperatively on persistent registrations."""
+    a, b = socketpair()
+    try:
+        with selectors.DefaultSelector() as sel:
+            sel.register(b, selectors.EVENT_READ, "b")
+            assert sel.select(0) == []
+            for _ in range(3):
+                async with anyio.create_task_group() as tg:
+                    await tg.spawn(sender, a, 0.05)
+                    (key, events), = sel.select()
+                assert key.fileobj is b and key.data == "b"
+                assert events == selectors.EVENT_READ
+                assert b.recv(10) == b"x"
+
+            sel.modify(b, selectors.EVENT_READ | selectors.EVENT_WRITE, "bw")
+            (key, events), = sel.select(1)
+            assert key.data == "bw" and events == selectors.EVENT_WRITE
+
+            sel.unregister(b)
+            t1 = time.time()
+            assert sel.select(0.2) == []
+            assert 0.19 < time.time() - t1 < 1
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,18 @@
+#
+# Test that setup() replaced the standard modules.
+#
+
+import sys
+
+import aevent
+
+def test_modules():
+    """Patched modules replace the originals, whenever they're imported."""
+    import queue
+    import concurrent.futures
+    import selectors
+    for m in aevent._patched_modules:
+        assert sys.modules[m].__name__ == "aevent._monkey." + m
+    assert concurrent.futures is sys.modules["concurrent.futures"]
+    if aevent._backend != "trio":
+        assert "trio" not in sys.modules
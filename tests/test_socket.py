@@ -0,0 +1,298 @@
+#
+# Test that socket I/O cooperates with other tasks.
+#
+
+import pytest
+
+import gc
+import os
+import socket
+import sys
+import time
+import warnings
+import anyio
+
+import aevent
+
+def socketpair():
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        srv.bind(("127.0.0.1", 0))
+        srv.listen(1)
+        a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        a.connect(srv.getsockname())
+        b, _ = srv.accept()
+    finally:
+        srv.close()
+    return a, b
+
+async def echo(sock, n):
+    for _ in range(n):
+        data = sock.recv(100)
+        sock.send(data)
+
+@pytest.mark.anyio
+async def test_echo():
+    """Data sent through a patched socket pair arrives."""
+    a, b = socketpair()
+    try:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(echo, b, 100)
+            for i in range(100):
+                msg = b"msg %d" % i
+                a.send(msg)
+                assert a.recv(100) == msg
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_busy_socket():
+    """A socket that always has data does not starve other tasks."""
+    a, b = socketpair()
+    done = False
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while not done:
+            ticks += 1
+            await anyio.sleep(0)
+
+    try:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(ticker)
+            a.send(b"x" * 1000)
+            for _ in range(1000):
+                assert b.recv(1) == b"x"
+            done = True
+        assert ticks > 1
+    finally:
+        a.close()
+        b.close()
+
+async def reader(sock, n, result):
+    with sock.makefile("rb") as f:
+        result.append(f.read(n))
+
+@pytest.mark.anyio
+async def test_sendall():
+    """sendall() and makefile() transfer large buffers."""
+    a, b = socketpair()
+    data = os.urandom(1000000)
+    result = []
+    try:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(reader, b, len(data), result)
+            a.sendall(data)
+        assert result == [data]
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_sendfile(tmp_path):
+    """sendfile() sends (part of) a file."""
+    a, b = socketpair()
+    data = os.urandom(1000000)
+    p = tmp_path / "data"
+    p.write_bytes(data)
+    result = []
+    try:
+        with p.open("rb") as f:
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(reader, b, 500000, result)
+                assert a.sendfile(f, 1000, 500000) == 500000
+            assert f.tell() == 501000
+        assert result == [data[1000:501000]]
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_sendfile_full(tmp_path):
+    """sendfile() on a full socket fails without falling back to send()."""
+    a, b = socketpair()
+    p = tmp_path / "data"
+    p.write_bytes(os.urandom(100000))
+    try:
+        a.setblocking(False)
+        with pytest.raises(BlockingIOError):
+            while True:
+                a.send(b"x" * 65536)
+        with p.open("rb") as f:
+            with pytest.raises(BlockingIOError):
+                a.sendfile(f)
+            a.settimeout(0.05)
+            with pytest.raises(socket.timeout):
+                a.sendfile(f)
+            assert f.tell() == 0
+    finally:
+        a.close()
+        b.close()
+
+async def send_later(sock, data):
+    await anyio.sleep(0.01)
+    sock.send(data)
+
+@pytest.mark.anyio
+async def test_unwatch():
+    """A socket's fd watcher is dropped when it's closed or collected."""
+    a, b = socketpair()
+    c, d = socketpair()
+    try:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(send_later, b, b"x")
+            assert a.recv(1) == b"x"  # waits, so there's a watcher
+        fin = a._aevent_fin
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ResourceWarning)
+            del a
+            gc.collect()
+        assert not fin.alive
+
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(send_later, c, b"y")
+            assert d.recv(1) == b"y"
+        fin = d._aevent_fin
+        d.close()
+        assert not fin.alive
+    finally:
+        b.close()
+        c.close()
+
+@pytest.mark.anyio
+async def test_accept_many():
+    """accept_many() takes all pending connections at once."""
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    clients = []
+    try:
+        srv.bind(("127.0.0.1", 0))
+        srv.listen(10)
+        for _ in range(5):
+            c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            c.connect(srv.getsockname())
+            clients.append(c)
+        time.sleep(0.1)
+        conns = srv.accept_many(4)
+        assert len(conns) == 4
+        conns += srv.accept_many()
+        assert len(conns) == 5
+        for conn, addr in conns:
+            assert type(conn) is type(srv)
+            assert conn.getpeername() == addr
+            conn.send(b"x")
+            conn.close()
+        for c in clients:
+            assert c.recv(1) == b"x"
+    finally:
+        srv.close()
+        for c in clients:
+            c.close()
+
+@pytest.mark.anyio
+async def test_batch():
+    """recv_batch() and send_batch() handle many datagrams at once."""
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        b.bind(("127.0.0.1", 0))
+        a.bind(("127.0.0.1", 0))
+        dest = b.getsockname()
+        assert a.send_batch((b"msg %d" % i, dest) for i in range(50)) == 50
+
+        msgs = []
+        while len(msgs) < 50:
+            for data, addr in b.recv_batch(20, 100):
+                assert addr == a.getsockname()
+                msgs.append(bytes(data))
+        assert msgs == [b"msg %d" % i for i in range(50)]
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_batch_nonblocking():
+    """send_batch() on a non-blocking socket reports partial progress."""
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        a.setblocking(False)
+        n = a.send_batch((b"x" * 1000, None) for _ in range(10000))
+        assert 0 < n < 10000
+        with pytest.raises(BlockingIOError):
+            a.send_batch([(b"x", None)])
+        assert len(b.recv_batch()) == min(n, 64)
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_timeout():
+    """Socket timeouts are honoured."""
+    a, b = socketpair()
+    try:
+        b.settimeout(0.2)
+        assert b.gettimeout() == 0.2
+        t1 = time.time()
+        with pytest.raises(socket.timeout):
+            b.recv(10)
+        assert 0.19 < time.time() - t1 < 1
+
+        b.setblocking(False)
+        assert b.gettimeout() == 0.0 and not b.getblocking()
+        with pytest.raises(BlockingIOError):
+            b.recv(10)
+
+        b.setblocking(True)
+        assert b.gettimeout() is None
+        a.send(b"x")
+        assert b.recv(10) == b"x"
+    finally:
+        a.close()
+        b.close()
+
+@pytest.mark.anyio
+async def test_resolver():
+    """Name resolution uses the configured resolver and its cache."""
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    calls = []
+
+    def resolver(host, port, family, type, proto, flags):
+        calls.append(host)
+        if host != "example.test":
+            return None
+        return [
+            # This port is closed. The next attempt starts immediately.
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", closed)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port)),
+        ]
+
+    try:
+        srv.bind(("127.0.0.1", 0))
+        srv.listen(1)
+        port = srv.getsockname()[1]
+        c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        c.bind(("127.0.0.1", 0))
+        closed = c.getsockname()[1]
+        c.close()
+
+        socket.set_resolver(resolver)
+        assert socket.gethostbyname("example.test") == "127.0.0.1"
+        assert socket.gethostbyname("127.0.0.2") == "127.0.0.2"
+
+        t1 = time.time()
+        c = socket.create_connection(("example.test", port), timeout=2)
+        assert time.time() - t1 < 0.2
+        assert c.getpeername() == ("127.0.0.1", port)
+        assert c.gettimeout() == 2
+        c.close()
+
+        with pytest.raises(ConnectionRefusedError):
+            socket.create_connection(("127.0.0.1", closed))
+        if sys.version_info >= (3, 11):
+            with pytest.raises(ExceptionGroup):
+                socket.create_connection(("127.0.0.1", closed), all_errors=True)
+        assert calls == ["example.test", "example.test"]
+    finally:
+        socket.set_resolver(None)
+        srv.close()
@@ -0,0 +1,337 @@
+#
+# Test the patched threading primitives.
+#
+
+import pytest
+
+import threading
+import time
+import anyio
+
+async def holder(lock, t, log):
+    with lock:
+        log.append("held")
+        time.sleep(t)
+    log.append("released")
+
+async def waiter(lock, n, log):
+    with lock:
+        log.append(n)
+
+@pytest.mark.anyio
+async def test_lock():
+    """Lock: try-lock, timeouts and FIFO hand-off."""
+    lock = threading.Lock()
+    assert lock.acquire(blocking=False)
+    assert lock.locked()
+    assert not lock.acquire(blocking=False)
+    t1 = time.time()
+    assert not lock.acquire(timeout=0.1)
+    assert 0.09 < time.time() - t1 < 1
+    lock.release()
+    assert not lock.locked()
+    with pytest.raises(RuntimeError):
+        lock.release()
+
+    log = []
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(holder, lock, 0.1, log)
+        await anyio.sleep(0.01)
+        for n in range(5):
+            await tg.spawn(waiter, lock, n, log)
+    assert log == ["held", "released", 0, 1, 2, 3, 4]
+    assert not lock.locked()
+
+async def rholder(lock, t, log):
+    with lock:
+        with lock:
+            log.append("held")
+            time.sleep(t)
+        time.sleep(t)
+    log.append("released")
+
+@pytest.mark.anyio
+async def test_rlock():
+    """RLock: reentrancy, ownership and hand-off."""
+    lock = threading.RLock()
+    assert lock.acquire()
+    assert lock.acquire(blocking=False)
+    lock.release()
+    lock.release()
+    with pytest.raises(RuntimeError):
+        lock.release()
+
+    log = []
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(rholder, lock, 0.05, log)
+        await anyio.sleep(0.01)
+        assert not lock.acquire(blocking=False)
+        for n in range(3):
+            await tg.spawn(waiter, lock, n, log)
+    assert log == ["held", "released", 0, 1, 2]
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+async def cwaiter(cond, n, log):
+    with cond:
+        if cond.wait(timeout=1):
+            log.append(n)
+
+@pytest.mark.anyio
+async def test_condition():
+    """Condition: notify, notify_all, timeouts and wait_for."""
+    cond = threading.Condition()
+    with pytest.raises(RuntimeError):
+        cond.notify()
+    with cond:
+        t1 = time.time()
+        assert not cond.wait(timeout=0.1)
+        assert 0.09 < time.time() - t1 < 1
+        assert cond.wait_for(lambda: True, timeout=0)
+
+    log = []
+    async with anyio.create_task_group() as tg:
+        for n in range(5):
+            await tg.spawn(cwaiter, cond, n, log)
+        await anyio.sleep(0.01)
+        with cond:
+            cond.notify(2)
+        await anyio.sleep(0.01)
+        assert sorted(log) == [0, 1]
+        with cond:
+            cond.notify_all()
+    assert sorted(log) == [0, 1, 2, 3, 4]
+
+    state = []
+    async def setter():
+        await anyio.sleep(0.05)
+        with cond:
+            state.append(1)
+            cond.notify()
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(setter)
+        with cond:
+            assert cond.wait_for(lambda: state, timeout=1)
+
+async def bwaiter(barrier, log):
+    log.append(barrier.wait())
+
+@pytest.mark.anyio
+async def test_barrier():
+    """Barrier: indices, action, generations, abort and timeout."""
+    actions = []
+    barrier = threading.Barrier(3, action=lambda: actions.append(1))
+    for _ in range(2):
+        log = []
+        async with anyio.create_task_group() as tg:
+            for _ in range(3):
+                await tg.spawn(bwaiter, barrier, log)
+        assert sorted(log) == [0, 1, 2]
+    assert actions == [1, 1]
+
+    with pytest.raises(threading.BrokenBarrierError):
+        barrier.wait(timeout=0.05)
+    assert barrier.broken
+    with pytest.raises(threading.BrokenBarrierError):
+        barrier.wait()
+    barrier.reset()
+    assert not barrier.broken
+    assert threading.Barrier(1).wait() == 0
+
+async def ewaiter(evt, log):
+    log.append(evt.wait(timeout=1))
+
+@pytest.mark.anyio
+async def test_event():
+    """Event: set, clear and waiting."""
+    evt = threading.Event()
+    assert not evt.is_set()
+    assert not evt.wait(timeout=0.01)
+    log = []
+    async with anyio.create_task_group() as tg:
+        for _ in range(3):
+            await tg.spawn(ewaiter, evt, log)
+        await anyio.sleep(0.01)
+        evt.set()
+        evt.set()
+    assert log == [True, True, True]
+    assert evt.wait()
+    evt.clear()
+    assert not evt.is_set()
+    assert evt._event is None
+
+async def sholder(sem, n, log):
+    with sem:
+        log.append(n)
+        time.sleep(0.05)
+
+@pytest.mark.anyio
+async def test_semaphore():
+    """Semaphore and BoundedSemaphore."""
+    sem = threading.BoundedSemaphore(2)
+    assert sem.acquire(blocking=False)
+    assert sem.acquire(blocking=False)
+    assert not sem.acquire(blocking=False)
+    assert not sem.acquire(timeout=0.05)
+    sem.release(2)
+    with pytest.raises(ValueError):
+        sem.release()
+
+    log = []
+    t1 = time.time()
+    async with anyio.create_task_group() as tg:
+        for n in range(4):
+            await tg.spawn(sholder, sem, n, log)
+    assert 0.09 < time.time() - t1 < 0.5
+    assert sorted(log) == [0, 1, 2, 3]
+    assert sem.acquire(blocking=False)
+
+@pytest.mark.anyio
+async def test_timer():
+    """Timer: ordering, cancellation and join."""
+    import aevent
+    log = []
+    async with aevent.runner():
+        timers = [threading.Timer(t, log.append, (t,)) for t in (0.03, 0.01, 0.02, 0.04)]
+        for t in timers:
+            t.start()
+        timers[3].cancel()
+        timers[2].join()
+        assert log == [0.01, 0.02]
+        timers[0].join()
+        assert not timers[0].is_alive()
+        assert timers[0].finished.is_set()
+        many = [threading.Timer(10, log.append, (0,)) for _ in range(1000)]
+        for t in many:
+            t.start()
+        for t in many:
+            t.cancel()
+    assert log == [0.01, 0.02, 0.03]
+
+class NamedThread(threading.Thread):
+    def __init__(self, log, n):
+        super().__init__(name="n%d" % n)
+        self.log = log
+        self.n = n
+
+    def run(self):
+        self.log.append((threading.current_thread().name, self.n))
+
+@pytest.mark.anyio
+async def test_thread_subclass():
+    """Thread can be subclassed."""
+    import aevent
+    log = []
+    async with aevent.runner():
+        threads = [NamedThread(log, n) for n in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert isinstance(threads[0], threading.Thread)
+    assert sorted(log) == [("n0", 0), ("n1", 1), ("n2", 2)]
+
+@pytest.mark.anyio
+async def test_timer_daemon():
+    """A pending daemon timer doesn't keep the runner alive."""
+    import aevent
+    log = []
+    t1 = time.monotonic()
+    async with aevent.runner():
+        timer = threading.Timer(10, log.append, (1,))
+        timer.daemon = True
+        timer.start()
+    assert time.monotonic() - t1 < 1
+    assert log == []
+    assert not timer.is_alive()
+    timer.join()
+
+def forever():
+    while True:
+        time.sleep(0.01)
+
+@pytest.mark.anyio
+async def test_thread_daemon():
+    """A daemon thread started just before the runner exits is cancelled."""
+    import aevent
+    t1 = time.monotonic()
+    async with aevent.runner():
+        thread = threading.Thread(target=forever, daemon=True)
+        thread.start()
+    assert time.monotonic() - t1 < 1
+    assert not thread.is_alive()
+
+class Counter(threading.local):
+    def __init__(self, start):
+        self.n = start
+
+async def lworker(loc, n, log):
+    assert loc.n == 10
+    loc.n += n
+    await anyio.sleep(0.01)
+    log.append(loc.n)
+
+@pytest.mark.anyio
+async def test_local():
+    """Task-local data."""
+    loc = Counter(10)
+    loc.n = 1
+    log = []
+    async with anyio.create_task_group() as tg:
+        for n in range(3):
+            await tg.spawn(lworker, loc, n, log)
+    assert sorted(log) == [10, 11, 12]
+    assert loc.n == 1
+    del loc.n
+    with pytest.raises(AttributeError):
+        loc.n
+
+class Doubler(threading.local):
+    @property
+    def double(self):
+        return self.n * 2
+
+    @double.setter
+    def double(self, value):
+        self.n = value // 2
+
+    def get(self):
+        return self.n
+
+@pytest.mark.anyio
+async def test_local_descriptor():
+    """Properties win over the task's dict, methods don't."""
+    loc = Doubler()
+    loc.double = 8
+    assert loc.n == 4
+    assert loc.double == 8
+    assert "double" not in loc.__dict__
+    assert loc.get() == 4
+    loc.get = lambda: "mine"
+    assert loc.get() == "mine"
+    del loc.get
+    assert loc.get() == 4
+
+def tworker(log, n):
+    log.append((threading.current_thread().name, n))
+    time.sleep(0.01)
+
+@pytest.mark.anyio
+async def test_thread():
+    """Thread: start, join and current_thread."""
+    import aevent
+    log = []
+    async with aevent.runner():
+        threads = [threading.Thread(target=tworker, args=(log, n), name="t%d" % n)
+                   for n in range(3)]
+        for t in threads:
+            t.start()
+            assert t.is_alive()
+        with pytest.raises(RuntimeError):
+            threads[0].start()
+        threads[0].join(timeout=0.001)
+        for t in threads:
+            t.join()
+            assert not t.is_alive()
+    assert sorted(log) == [("t0", 0), ("t1", 1), ("t2", 2)]
+    assert threading.current_thread() is threading.main_thread()
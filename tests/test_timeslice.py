@@ -0,0 +1,65 @@
+#
+# Test time slicing of CPU-bound sync code.
+#
+
+import pytest
+
+import threading
+import time
+import anyio
+import aevent
+
+def spin(t, tag, log):
+    end = time.perf_counter() + t
+    while time.perf_counter() < end:
+        if log[-1] != tag:
+            log.append(tag)
+
+def spinner(t, tag, log, times):
+    spin(t, tag, log)
+    times[tag] = aevent.task_time()
+
+async def run_spinners(t, log, times):
+    async with aevent.runner():
+        threads = [threading.Thread(target=spinner, args=(t, tag, log, times))
+                   for tag in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+@pytest.mark.anyio
+async def test_timeslice(anyio_backend):
+    """Busy threads take turns, and their run time is recorded."""
+    # both spin for the same wall-clock time, so each runs for about half of it
+    log = [None]
+    times = {}
+    aevent._timeslice.start(anyio_backend, 5)
+    try:
+        await run_spinners(0.2, log, times)
+    finally:
+        aevent._timeslice.stop()
+    assert len(log) > 5
+    assert 0.05 < times["a"] < 0.25
+    assert 0.05 < times["b"] < 0.25
+
+    # off again
+    log = [None]
+    await run_spinners(0.05, log, times)
+    assert len(log) == 3
+
+async def busy(t, tag, log):
+    spin(t, tag, log)
+
+@pytest.mark.anyio
+async def test_no_slice_async(anyio_backend):
+    """Async code that never awaits anything is not interrupted."""
+    log = [None]
+    aevent._timeslice.start(anyio_backend, 5)
+    try:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(busy, 0.05, "a", log)
+            await tg.spawn(busy, 0.05, "b", log)
+    finally:
+        aevent._timeslice.stop()
+    assert log == [None, "a", "b"]